@@ -15,6 +15,15 @@ def _name_to_solver(name):
     elif name == 'qiskit':
         import nchoosek.solver.qiskit
         return nchoosek.solver.qiskit.solve
+    elif name == 'anneal':
+        import nchoosek.solver.anneal
+        return nchoosek.solver.anneal.solve
+    elif name == 'exact':
+        import nchoosek.solver.exact
+        return nchoosek.solver.exact.solve
+    elif name == 'decompose':
+        import nchoosek.solver.decompose
+        return nchoosek.solver.decompose.solve
     else:
         raise ValueError('"%s" is not a recognized NchooseK solver' % name)
 
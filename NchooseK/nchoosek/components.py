@@ -0,0 +1,209 @@
+########################################
+# Split an NchooseK environment into   #
+# independent components, solve each,  #
+# and recombine the results            #
+########################################
+
+from concurrent.futures import ProcessPoolExecutor
+from nchoosek.core import Environment
+from nchoosek.solver import Result, SampleSet, default_hard_scale
+import math
+import numpy as np
+import os
+import scipy.sparse.csgraph
+
+# Modules whose solvers accept pack_components=True, with which they solve
+# all components in a single call (e.g., one sampler call with each
+# component embedded separately into its own qubits).
+PACKING_SOLVERS = ['nchoosek.solver.ocean']
+
+# Modules whose solvers return every optimal solution rather than a number
+# of independent reads
+ENUMERATING_SOLVERS = ['nchoosek.solver.exact']
+
+# Status of a combined result, from highest to lowest precedence
+_STATUS_ORDER = ['infeasible', 'timeout', 'feasible', 'optimal']
+
+
+def split(env):
+    '''Partition an environment into environments that share no ports and
+    no constraints.  Ports that appear in no constraint are gathered into a
+    single, unconstrained environment.'''
+    cenv = env.compile()
+    inc = cenv.incidence()
+    adj = (inc.T @ inc).tocsr()
+    _, labels = scipy.sparse.csgraph.connected_components(adj, directed=False)
+
+    # Label each constraint with the component of its first port.
+    con_labels = np.zeros(cenv.num_constraints, dtype=np.int64)
+    counts = np.diff(cenv.indptr)
+    has_ports = counts > 0
+    con_labels[has_ports] = labels[cenv.indices[cenv.indptr[:-1][has_ports]]]
+    used = np.zeros(cenv.num_ports, dtype=bool)
+    used[cenv.indices] = True
+
+    # Build one environment per component.
+    envs = {}
+    for lbl in sorted(set(labels[used].tolist())):
+        envs[lbl] = Environment()
+    if not used.all() or len(envs) == 0:
+        envs[-1] = Environment()
+    for i, p in enumerate(cenv.ports):
+        envs[labels[i] if used[i] else -1].register_port(p)
+    first = min(envs)
+    for i, c in enumerate(cenv.constraints):
+        envs[con_labels[i] if has_ports[i] else first]._constraints.append(c)
+    return list(envs.values())
+
+
+def _as_rows(result, ports):
+    '''Return a result's solutions as a 0/1 matrix over the given ports, a
+    vector of tallies, and a vector of energies (or None).'''
+    if result.samples is not None:
+        rows = result.samples.array(ports)
+        tallies = result.samples.tallies
+        energies = result.samples.energies
+    else:
+        solns = result.solutions or []
+        rows = np.array([[s[p] for p in ports] for s in solns],
+                        dtype=bool).reshape(len(solns), len(ports))
+        tallies = result.tallies
+        if tallies is None:
+            tallies = np.ones(len(solns), dtype=np.int64)
+        tallies = np.asarray(tallies)
+        energies = result.energies
+        if energies is not None:
+            energies = np.asarray(energies)
+    return rows.astype(bool), tallies, energies
+
+
+def _pair_rows(parts):
+    '''Combine components' samples read by read: the i-th best read of
+    each component forms the i-th combined read.'''
+    rows = []
+    energies = []
+    for r, t, e in parts:
+        order = np.argsort(e, kind='stable') if e is not None else \
+            np.argsort(-t, kind='stable')
+        reps = np.repeat(order, t[order])
+        rows.append(r[reps])
+        if e is not None:
+            energies.append(e[reps])
+    energies = sum(energies) if len(energies) == len(parts) else None
+    return np.hstack(rows), np.ones(len(rows[0]), dtype=np.int64), energies
+
+
+def _cross_rows(parts, max_combinations):
+    '''Combine components' samples by taking the Cartesian product of their
+    solutions, keeping at most max_combinations of the best combinations
+    after each step.'''
+    rows, tallies, energies = parts[0]
+    for r, t, e in parts[1:]:
+        i, j = np.divmod(np.arange(len(rows)*len(r)), len(r))
+        rows = np.hstack([rows[i], r[j]])
+        tallies = tallies[i]*t[j]
+        if energies is not None and e is not None:
+            energies = energies[i] + e[j]
+        else:
+            energies = None
+        if len(rows) > max_combinations:
+            if energies is not None:
+                keep = np.lexsort((-tallies, energies))[:max_combinations]
+                energies = energies[keep]
+            else:
+                keep = np.argsort(-tallies, kind='stable')[:max_combinations]
+            rows, tallies = rows[keep], tallies[keep]
+    return rows, tallies, energies
+
+
+def combine(env, envs, results, pair_reads=True, max_combinations=1000):
+    '''Combine the results of solving each component of an environment
+    into a single result.  If pair_reads is True and every component
+    reports the same total tally (i.e., the same number of reads), reads
+    are paired up; otherwise, all combinations of solutions are formed.'''
+    cenv = env.compile()
+    ret = Result()
+    statuses = [r.status for r in results]
+    if None not in statuses:
+        ret.status = min(statuses, key=_STATUS_ORDER.index)
+    # Components are solved one at a time, so the largest determines the
+    # number of qubits needed.
+    ret.qubits = max([r.qubits or 0 for r in results]) or None
+    ret.depth = max([r.depth or 0 for r in results]) or None
+    ret.quantum_instance = results[0].quantum_instance
+    times = [r.times for r in results if r.times is not None]
+    if len(times) > 0:
+        ret.times = (min([t[0] for t in times]), max([t[1] for t in times]))
+    bounds = [r.bounds for r in results]
+    if None not in bounds:
+        ret.bounds = (sum([b[0] for b in bounds]),
+                      sum([b[1] for b in bounds]))
+
+    # Combine the solutions.
+    ports = []
+    parts = []
+    for e, r in zip(envs, results):
+        eports = sorted(e.ports())
+        ports.extend(eports)
+        parts.append(_as_rows(r, eports))
+    if any([len(p[0]) == 0 for p in parts]):
+        ret.solutions = []
+        return ret
+    totals = {int(p[1].sum()) for p in parts}
+    if pair_reads and len(totals) == 1:
+        rows, tallies, energies = _pair_rows(parts)
+    else:
+        rows, tallies, energies = _cross_rows(parts, max_combinations)
+    position = {p: i for i, p in enumerate(ports)}
+    order = [position[p] for p in cenv.ports]
+    ret.samples = SampleSet.from_samples(cenv.ports, rows[:, order], energies,
+                                         tallies, cenv.port_index)
+    return ret
+
+
+def _solve_one(args):
+    '''Solve a single component, and make its result safe to return from
+    another process.'''
+    solve_func, env, args, kwargs = args
+    result = solve_func(env, *args, **kwargs)
+    if result.samples is not None:
+        result.samples.port_index = dict(result.samples.port_index)
+    return result
+
+
+def solve_components(env, solve_func, args, kwargs, num_workers=1,
+                     max_combinations=1000):
+    '''Solve each component of an environment separately, using up to
+    num_workers processes (all cores if None), and combine the results.
+    Solvers that can pack components into a single call instead receive
+    the whole environment and pack_components=True.'''
+    if solve_func.__module__ in PACKING_SOLVERS:
+        kwargs = dict(kwargs)
+        kwargs.setdefault('pack_components', True)
+        return solve_func(env, *args, **kwargs)
+    envs = split(env)
+    if len(envs) == 1:
+        return solve_func(env, *args, **kwargs)
+
+    # All components must weigh hard constraints the same for their
+    # energies to be comparable.
+    kwargs = dict(kwargs)
+    if kwargs.get('hard_scale') is None:
+        kwargs['hard_scale'] = default_hard_scale(env)
+
+    # Divide any time limit among the batches of components.
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(envs)))
+    if kwargs.get('time_limit') is not None:
+        nbatches = math.ceil(len(envs)/num_workers)
+        kwargs['time_limit'] = kwargs['time_limit']/nbatches
+
+    tasks = [(solve_func, e, args, kwargs) for e in envs]
+    if num_workers == 1:
+        results = [_solve_one(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            results = list(pool.map(_solve_one, tasks))
+    pair_reads = solve_func.__module__ not in ENUMERATING_SOLVERS
+    return combine(env, envs, results, pair_reads, max_combinations)
@@ -3,9 +3,14 @@
 ##################################
 
 import nchoosek
+from collections.abc import Mapping
 from nchoosek.solver.bqm import BQMMixin
+from nchoosek.solver.common import SampleSet
+import numpy as np
 import os
+import scipy.sparse
 import shlex
+import types
 
 
 class UnknownPortError(Exception):
@@ -36,16 +41,20 @@ class DuplicatePortError(Exception):
 class Constraint(BQMMixin):
     'Representation of a constraint (k of n ports are True).'
 
-    def __init__(self, port_list, num_true, soft=False):
+    def __init__(self, port_list, num_true, soft=False, weight=1):
         self.port_list = list(port_list)  # Ports; can include duplicates
         self.num_true = set(num_true)     # Set of allowable True counts
         self.soft = soft                  # true: allow constraint to be broken
+        self.weight = weight              # Cost of breaking a soft constraint
 
     def __str__(self):
         'Return a constraint as a string.'
         msg = '%s choose %s' % (self.port_list, self.num_true)
         if self.soft:
-            msg += ' (soft)'
+            if self.weight == 1:
+                msg += ' (soft)'
+            else:
+                msg += ' (soft, weight %s)' % self.weight
         return msg
 
 
@@ -63,13 +72,14 @@ class Block(object):
             lps = self._constraint.port_list
             vals = self._constraint.num_true
             soft = self._constraint.soft
+            weight = self._constraint.weight
             gps = ['%s.%s' % (self._unique_id, lp) for lp in lps]
             gps_set = set(gps)
             dups = env._port_names & gps_set
             if len(dups) > 0:
                 raise DuplicatePortError(dups.pop())
             env._port_names |= gps_set
-            env._constraints.append(Constraint(gps, vals, soft))
+            env._constraints.append(Constraint(gps, vals, soft, weight))
 
         # If a list of port bindings was provided, equate those to the
         # global port names.
@@ -101,6 +111,172 @@ class Block(object):
         raise KeyError(key)
 
 
+class CompiledEnvironment(object):
+    '''Immutable, array-based representation of an Environment.  Ports are
+    numbered by their position in the sorted list of port names.  The
+    constraint-port incidence matrix is stored in compressed sparse row
+    (CSR) form, with one row per constraint and with port multiplicities as
+    values.  The allowed True counts of constraint i are
+    k_values[k_offsets[i]:k_offsets[i + 1]], sorted and limited to counts
+    the constraint can achieve.  weights holds each constraint's weight,
+    which matters only for soft constraints.'''
+
+    # Maximum number of entries in a table of allowed counts.
+    MAX_TABLE_SIZE = 2**26
+
+    def __init__(self, env):
+        # Intern all port names.
+        self.ports = tuple(sorted(env._port_names))
+        self.port_index = types.MappingProxyType(
+            {p: i for i, p in enumerate(self.ports)})
+        self.constraints = tuple(env._constraints)
+
+        # Construct the incidence matrix and the lists of allowed counts.
+        indptr = [0]
+        indices = []
+        data = []
+        k_offsets = [0]
+        k_values = []
+        for c in self.constraints:
+            tally = {}
+            for p in c.port_list:
+                idx = self.port_index[p]
+                tally[idx] = tally.get(idx, 0) + 1
+            for idx in sorted(tally):
+                indices.append(idx)
+                data.append(tally[idx])
+            indptr.append(len(indices))
+            total = len(c.port_list)
+            k_values.extend(sorted([k for k in c.num_true if 0 <= k <= total]))
+            k_offsets.append(len(k_values))
+        self.indptr = self._frozen(indptr)
+        self.indices = self._frozen(indices)
+        self.data = self._frozen(data)
+        self.k_offsets = self._frozen(k_offsets)
+        self.k_values = self._frozen(k_values)
+        self.soft = self._frozen([c.soft for c in self.constraints], bool)
+        self.weights = self._frozen([c.weight for c in self.constraints],
+                                    None)
+
+        # Encode each (constraint, allowed count) pair as a single integer
+        # so that membership tests for all constraints at once reduce to a
+        # binary search.
+        self._stride = max([len(c.port_list) for c in self.constraints],
+                           default=0) + 1
+        owners = np.repeat(np.arange(self.num_constraints),
+                           np.diff(self.k_offsets))
+        self._k_keys = self._frozen(owners*self._stride + self.k_values)
+        table = None
+        if self.num_constraints*self._stride <= self.MAX_TABLE_SIZE:
+            # Small enough for a direct lookup table
+            table = np.zeros(self.num_constraints*self._stride, dtype=bool)
+            table[self._k_keys] = True
+            table.flags.writeable = False
+        self._k_table = table
+        self._incidence = self.incidence()
+        self._constrained = self._frozen(
+            np.bincount(self.indices, minlength=self.num_ports) > 0, bool)
+
+    @staticmethod
+    def _frozen(values, dtype=np.int64):
+        'Convert a list to a read-only NumPy array.'
+        arr = np.array(values, dtype=dtype)
+        arr.flags.writeable = False
+        return arr
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError('%s is immutable' % type(self).__name__)
+        super().__setattr__(name, value)
+
+    @property
+    def num_ports(self):
+        'Return the number of ports.'
+        return len(self.ports)
+
+    @property
+    def num_constraints(self):
+        'Return the number of constraints.'
+        return len(self.constraints)
+
+    def incidence(self):
+        '''Return the constraint-port incidence matrix as a SciPy CSR
+        matrix.'''
+        return scipy.sparse.csr_matrix((self.data, self.indices, self.indptr),
+                                       shape=(self.num_constraints,
+                                              self.num_ports))
+
+    def constraint_ports(self, i):
+        '''Return the port indices and multiplicities of constraint i as a
+        pair of arrays.'''
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        return self.indices[lo:hi], self.data[lo:hi]
+
+    def column_info(self, i):
+        '''Return constraint i's columns as a list of (port index, tally)
+        pairs ordered by tally, then by port index.  This is the canonical
+        column order of the constraint's QUBO template (cf.
+        Constraint._column_info).'''
+        idxs, mults = self.constraint_ports(i)
+        order = np.lexsort((idxs, mults))
+        return list(zip(idxs[order].tolist(), mults[order].tolist()))
+
+    def allowed(self, i):
+        'Return the allowed True counts of constraint i as an array.'
+        return self.k_values[self.k_offsets[i]:self.k_offsets[i + 1]]
+
+    def to_vector(self, soln):
+        '''Convert a mapping from port names to Booleans to a 0/1 vector
+        indexed by port number.  Ports that no constraint uses may be
+        omitted from the mapping; they are taken to be False.'''
+        return np.array([soln[p] if used else soln.get(p, False)
+                         for p, used in zip(self.ports, self._constrained)],
+                        dtype=np.int8)
+
+    def satisfied(self, soln):
+        '''Return a Boolean vector indicating which constraints a solution,
+        either a mapping from port names to Booleans or a 0/1 vector,
+        satisfies.'''
+        if not isinstance(soln, np.ndarray):
+            soln = self.to_vector(soln)
+        return self.satisfied_matrix(soln.reshape(1, -1))[:, 0]
+
+    def satisfied_matrix(self, samples):
+        '''Given an (n_samples x n_ports) 0/1 matrix, return an
+        (n_constraints x n_samples) Boolean matrix indicating which
+        constraints each sample satisfies.'''
+        counts = self._incidence.dot(np.asarray(samples, dtype=np.int64).T)
+        keys = counts + (np.arange(self.num_constraints)*self._stride)[:, None]
+        if self._k_table is not None:
+            return self._k_table[keys]
+        if len(self._k_keys) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        pos = np.searchsorted(self._k_keys, keys)
+        pos = np.minimum(pos, len(self._k_keys) - 1)
+        return self._k_keys[pos] == keys
+
+    def batch_validation(self, samples, chunk_size=1024, weighted=False):
+        '''Given an (n_samples x n_ports) 0/1 matrix, return a vector of the
+        number of hard constraints each sample violates and a vector of the
+        number (or, if weighted is True, the total weight) of soft
+        constraints each sample satisfies.'''
+        samples = np.asarray(samples)
+        nsamples = samples.shape[0]
+        hard_failed = np.empty(nsamples, dtype=np.int64)
+        if weighted:
+            soft_weights = np.where(self.soft, self.weights, 0)
+        else:
+            soft_weights = self.soft.astype(np.int64)
+        soft_passed = np.empty(nsamples, dtype=soft_weights.dtype)
+        hard = ~self.soft
+        for lo in range(0, nsamples, chunk_size):
+            hi = min(lo + chunk_size, nsamples)
+            sat = self.satisfied_matrix(samples[lo:hi])
+            hard_failed[lo:hi] = (~sat & hard[:, None]).sum(axis=0)
+            soft_passed[lo:hi] = soft_weights @ sat
+        return hard_failed, soft_passed
+
+
 class Environment(object):
     'A namespace for a set of related NchooseK operations.'
 
@@ -109,6 +285,7 @@ class Environment(object):
         self._constraints = []    # All constraints within this environment
         self._port_names = set()  # All port names within this environment
         self._next_id = 1         # Next available unique ID for an object
+        self._compiled = None     # Cached result of compile()
 
     def register_port(self, port_name):
         '''Register a new, environment-global port name.  Return the
@@ -141,43 +318,46 @@ class Environment(object):
             '_constraint': constraint,
             'env': self})
 
-    def same(self, gp1, gp2, soft=False):
+    def same(self, gp1, gp2, soft=False, weight=1):
         'Declare that two environment-global ports must have the same value.'
         if gp1 not in self._port_names:
             raise UnknownPortError(None, gp1)
         if gp2 not in self._port_names:
             raise UnknownPortError(None, gp2)
-        self._constraints.append(Constraint([gp1, gp2], {0, 2}, soft))
+        self._constraints.append(Constraint([gp1, gp2], {0, 2}, soft,
+                                            weight))
 
-    def different(self, gp1, gp2, soft=False):
+    def different(self, gp1, gp2, soft=False, weight=1):
         'Declare that two environment-global ports must have different values.'
         if gp1 not in self._port_names:
             raise UnknownPortError(None, gp1)
         if gp2 not in self._port_names:
             raise UnknownPortError(None, gp2)
-        self._constraints.append(Constraint([gp1, gp2], {1}, soft))
+        self._constraints.append(Constraint([gp1, gp2], {1}, soft,
+                                            weight))
 
-    def minimize(self, gps):
+    def minimize(self, gps, weight=1):
         'Try to set as few environment-global ports to True as possible.'
         for p in gps:
             if p not in self._port_names:
                 raise UnknownPortError(None, p)
-            self._constraints.append(Constraint([p], {0}, soft=True))
+            self._constraints.append(Constraint([p], {0}, True, weight))
 
-    def maximize(self, gps):
+    def maximize(self, gps, weight=1):
         'Try to set as mant environment-global ports to True as possible.'
         for p in gps:
             if p not in self._port_names:
                 raise UnknownPortError(None, p)
-            self._constraints.append(Constraint([p], {1}, soft=True))
+            self._constraints.append(Constraint([p], {1}, True, weight))
 
-    def nck(self, gps, vals, soft=False):
+    def nck(self, gps, vals, soft=False, weight=1):
         '''Add a new constraint to the environment.  This method accepts
-        only environment-global ports, not type-local port names.'''
+        only environment-global ports, not type-local port names.  weight
+        is the cost of breaking the constraint if it is soft.'''
         for gp in gps:
             if gp not in self._port_names:
                 raise UnknownPortError(None, gp)
-        self._constraints.append(Constraint(gps, vals, soft))
+        self._constraints.append(Constraint(gps, vals, soft, weight))
 
     def __str__(self):
         'Return an environment as a single string.'
@@ -195,8 +375,30 @@ class Environment(object):
         # set to reinforce that the order is meaningless.
         return set(self._constraints)
 
-    def solve(self, solver=None, *args, **kwargs):
-        'Solve for all constraints in the environment.'
+    def compile(self):
+        '''Return an immutable, array-based representation of the
+        environment.'''
+        # Ports and constraints can be added but never removed, so their
+        # counts suffice to tell if a previously compiled form is stale.
+        if self._compiled is not None:
+            cenv = self._compiled
+            if cenv.num_ports == len(self._port_names) and \
+               cenv.num_constraints == len(self._constraints):
+                return cenv
+        self._compiled = CompiledEnvironment(self)
+        return self._compiled
+
+    def solve(self, solver=None, *args, time_limit=None, presolve=False,
+              components=False, component_workers=1, **kwargs):
+        '''Solve for all constraints in the environment.  If time_limit is
+        given, ask the solver to return its best result after roughly that
+        many seconds.  If presolve is True, simplify the environment before
+        solving it.  If components is True, solve each independent
+        component of the environment separately, using up to
+        component_workers processes (all cores if None).  Every solver
+        accepts an initial_solution keyword argument (one or more
+        {port name: Boolean} maps, or a previous Result) from which to
+        warm-start its search.'''
         # Parse key=value pairs in the NCHOOSEK_PARAMS environment variable.
         all_kwargs = {}
         var_params = os.getenv('NCHOOSEK_PARAMS')
@@ -222,10 +424,34 @@ class Environment(object):
 
         # Invoke the solver.
         all_kwargs.update(**kwargs)
+        if time_limit is not None:
+            all_kwargs['time_limit'] = time_limit
         solve_func = nchoosek.solve
         if solver is not None:
             solve_func = nchoosek._name_to_solver(solver)
-        return solve_func(self, *args, **all_kwargs)
+        env = self
+        if presolve:
+            from nchoosek.presolve import presolve as presolve_env
+            pre = presolve_env(self)
+            env = pre.env
+        if components:
+            from nchoosek.components import solve_components
+            result = solve_components(env, solve_func, args, all_kwargs,
+                                      component_workers)
+        else:
+            result = solve_func(env, *args, **all_kwargs)
+        if presolve:
+            result = pre.expand_result(result)
+        return result
+
+    def estimate_resources(self, target='pegasus', size=None,
+                           circuit_model=None, **kwargs):
+        '''Estimate locally, without running a solver, the logical
+        variables, ancillae, interactions, and embedded qubits and chain
+        lengths needed to solve the environment on a target hardware graph.
+        Return a ResourceEstimate.'''
+        from nchoosek.resources import estimate
+        return estimate(self, target, size, circuit_model, **kwargs)
 
     class Validation(object):
         'Encapsulate the status of a validation check.'
@@ -240,10 +466,9 @@ class Environment(object):
         '''Return a Validation object that partitions constraints based on
         their pass/fail status.'''
         result = self.Validation()
-        for c in self._constraints:
-            port_values = [soln[p] for p in c.port_list]
-            num_true = sum(port_values)
-            if num_true in c.num_true:
+        cenv = self.compile()
+        for c, sat in zip(cenv.constraints, cenv.satisfied(soln)):
+            if sat:
                 # Pass
                 if c.soft:
                     result.soft_passed.append(c)
@@ -257,15 +482,34 @@ class Environment(object):
                     result.hard_failed.append(c)
         return result
 
+    def batch_validation(self, samples, weighted=False):
+        '''Validate many solutions at once.  Given either a SampleSet, a
+        sequence of mappings from port names to Booleans, or an (n_samples x
+        n_ports) 0/1 matrix with columns ordered as in compile().ports,
+        return a vector of the number of hard constraints each sample
+        violates and a vector of the number (or, if weighted is True, the
+        total weight) of soft constraints each sample satisfies.'''
+        cenv = self.compile()
+        if isinstance(samples, SampleSet):
+            samples = samples.array(cenv.ports)
+        elif len(samples) > 0 and isinstance(samples[0], Mapping):
+            samples = np.array([cenv.to_vector(s) for s in samples])
+        return cenv.batch_validation(samples, weighted=weighted)
+
     def valid(self, soln):
         'Return True if all hard constraints are satisfied, False otherwise.'
         raw = self.validation(soln)
         return len(raw.hard_failed) == 0
 
-    def quality(self, soln):
+    def quality(self, soln, weighted=False):
         '''Return the number of soft constraints which passed and the total
-        number of soft constraints.'''
+        number of soft constraints.  If weighted is True, return the total
+        weight of each instead.'''
         raw = self.validation(soln)
-        soft = len(raw.soft_passed)
-        total = soft + len(raw.soft_failed)
+        if weighted:
+            soft = sum([c.weight for c in raw.soft_passed])
+            total = soft + sum([c.weight for c in raw.soft_failed])
+        else:
+            soft = len(raw.soft_passed)
+            total = soft + len(raw.soft_failed)
         return soft, total
@@ -0,0 +1,220 @@
+########################################
+# Simplify an NchooseK environment     #
+# before handing it to a solver        #
+########################################
+
+from nchoosek.core import Constraint, Environment
+from nchoosek.solver import Result, SampleSet
+import numpy as np
+
+
+def _sum_mask(weights):
+    '''Return a bit mask in which bit s is set if some subset of the given
+    weights sums to s.'''
+    mask = 1
+    for w in weights:
+        mask |= mask << w
+    return mask
+
+
+class _UnionFind(object):
+    'Disjoint sets of port names.'
+
+    def __init__(self, names):
+        self.parent = {n: n for n in names}
+
+    def find(self, n):
+        'Return the representative of the set containing n.'
+        root = n
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[n] != root:
+            self.parent[n], n = root, self.parent[n]
+        return root
+
+    def union(self, n1, n2):
+        'Merge the sets containing n1 and n2.'
+        r1, r2 = self.find(n1), self.find(n2)
+        if r1 != r2:
+            # The lexicographically smaller name represents the set.
+            if r2 < r1:
+                r1, r2 = r2, r1
+            self.parent[r2] = r1
+
+
+class _Reduction(object):
+    '''A constraint in the process of being simplified: a map from free
+    ports to multiplicities, the number of True fixed ports, and the
+    original constraint.'''
+
+    def __init__(self, c, uf):
+        self.orig = c
+        self.free = {}
+        for p in c.port_list:
+            rep = uf.find(p)
+            self.free[rep] = self.free.get(rep, 0) + 1
+        self.fixed_true = 0
+        self.dropped = False
+
+    def allowed_mask(self):
+        'Return a bit mask of the allowed sums of the free ports.'
+        mask = 0
+        for k in self.orig.num_true:
+            k -= self.fixed_true
+            if k >= 0:
+                mask |= 1 << k
+        return mask
+
+    def fix(self, port, value):
+        "Assign a value to one of the constraint's free ports."
+        mult = self.free.pop(port)
+        if value:
+            self.fixed_true += mult
+
+    def forced(self):
+        '''Return a list of (port, value) pairs for all free ports whose
+        value is implied by the constraint, or None if the constraint cannot
+        be satisfied.'''
+        if self.never_satisfied():
+            return None
+        allowed = self.allowed_mask()
+        implied = []
+        for p, m in self.free.items():
+            others = _sum_mask([w for q, w in self.free.items() if q != p])
+            can_be_false = others & allowed != 0
+            can_be_true = (others << m) & allowed != 0
+            if not can_be_false:
+                implied.append((p, True))
+            elif not can_be_true:
+                implied.append((p, False))
+        return implied
+
+    def always_satisfied(self):
+        'Return True if every assignment to the free ports is allowed.'
+        achievable = _sum_mask(self.free.values())
+        return achievable & ~self.allowed_mask() == 0
+
+    def never_satisfied(self):
+        'Return True if no assignment to the free ports is allowed.'
+        achievable = _sum_mask(self.free.values())
+        return achievable & self.allowed_mask() == 0
+
+    def constraint(self):
+        'Return a Constraint over the free ports.'
+        ports = []
+        for p, m in sorted(self.free.items()):
+            ports.extend([p]*m)
+        total = len(ports)
+        vals = {k - self.fixed_true for k in self.orig.num_true}
+        vals = {k for k in vals if 0 <= k <= total}
+        return Constraint(ports, vals, self.orig.soft, self.orig.weight)
+
+
+class Presolved(object):
+    '''Reduced version of an environment plus the information needed to map
+    solutions of the reduced environment back to the original.'''
+
+    def __init__(self, orig_env, env, rep, fixed):
+        self.orig_env = orig_env  # Original environment
+        self.env = env            # Reduced environment
+        self.rep = rep            # Map from original ports to representatives
+        self.fixed = fixed        # Map from representatives to fixed values
+
+    def expand(self, soln):
+        '''Map a solution of the reduced environment to a solution of the
+        original environment.'''
+        ret = {}
+        for p, r in self.rep.items():
+            if r in self.fixed:
+                ret[p] = self.fixed[r]
+            else:
+                ret[p] = bool(soln[r])
+        return ret
+
+    def expand_samples(self, samples):
+        'Map a SampleSet over the reduced environment to the original.'
+        cenv = self.orig_env.compile()
+        reduced = samples.array()
+        arr = np.zeros((len(samples), cenv.num_ports), dtype=bool)
+        for j, p in enumerate(cenv.ports):
+            r = self.rep[p]
+            if r in self.fixed:
+                arr[:, j] = self.fixed[r]
+            else:
+                arr[:, j] = reduced[:, samples.port_index[r]]
+        return SampleSet(cenv.ports, arr, samples.tallies, samples.energies,
+                         cenv.port_index)
+
+    def expand_result(self, result):
+        '''Map a Result from solving the reduced environment to a Result for
+        the original environment.'''
+        ret = Result()
+        ret.__dict__.update(result.__dict__)
+        if result.samples is not None:
+            ret.samples = self.expand_samples(result.samples)
+        if result._solutions is not None:
+            ret.solutions = [self.expand(s) for s in result._solutions]
+        return ret
+
+
+def presolve(env):
+    '''Simplify an environment by merging ports that hard constraints
+    require to be equal, assigning values to ports whose values are implied
+    by hard constraints, and dropping constraints that can no longer be
+    violated.  Return a Presolved object.'''
+    # Merge ports related by hard, two-port "same" constraints.
+    uf = _UnionFind(env.ports())
+    for c in env._constraints:
+        if not c.soft and c.num_true == {0, 2} and \
+           len(set(c.port_list)) == 2 and len(c.port_list) == 2:
+            uf.union(*c.port_list)
+
+    # Rewrite each constraint in terms of representatives.
+    reds = [_Reduction(c, uf) for c in env._constraints]
+    uses = {}
+    for i, r in enumerate(reds):
+        for p in r.free:
+            uses.setdefault(p, []).append(i)
+
+    # Repeatedly assign values implied by hard constraints and propagate
+    # them to all constraints.  An unsatisfiable constraint is left in place
+    # for the solver to report.
+    fixed = {}
+    queue = [i for i, r in enumerate(reds) if not r.orig.soft]
+    queued = set(queue)
+    while len(queue) > 0:
+        i = queue.pop()
+        queued.discard(i)
+        r = reds[i]
+        if r.dropped:
+            continue
+        implied = r.forced()
+        if implied is None:
+            continue
+        for p, val in implied:
+            if p in fixed:
+                continue
+            fixed[p] = val
+            for j in uses[p]:
+                reds[j].fix(p, val)
+                if not reds[j].orig.soft and j not in queued:
+                    queue.append(j)
+                    queued.add(j)
+        if r.always_satisfied():
+            r.dropped = True
+
+    # Build the reduced environment.
+    reduced = Environment()
+    for p in sorted({uf.find(p) for p in env.ports()}):
+        if p not in fixed:
+            reduced.register_port(p)
+    for r in reds:
+        if r.dropped or r.always_satisfied():
+            continue
+        if r.orig.soft and r.never_satisfied():
+            # A soft constraint that is certain to be broken affects only
+            # the quality of the solution, not which solution is best.
+            continue
+        reduced._constraints.append(r.constraint())
+    rep = {p: uf.find(p) for p in env.ports()}
+    return Presolved(env, reduced, rep, fixed)
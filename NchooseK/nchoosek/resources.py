@@ -0,0 +1,101 @@
+########################################
+# Estimate the hardware resources an   #
+# NchooseK environment would need      #
+# without submitting it to a solver    #
+########################################
+
+from nchoosek.solver import construct_indexed_qubo
+from nchoosek.solver.embedding import Topology, embedding_cache, topology
+import networkx as nx
+
+
+class ResourceEstimate(object):
+    '''Logical and physical resources needed to solve an environment on a
+    given hardware graph.  On annealers, each QUBO variable maps to a chain
+    of physical qubits.  On circuit-model hardware (circuit_model is True),
+    each QUBO variable maps to a single qubit, routed with SWAPs; the chain
+    statistics then describe a SWAP-free layout.'''
+
+    def __init__(self, target, target_qubits, circuit_model):
+        self.target = target                # Name of the hardware graph
+        self.target_qubits = target_qubits  # Number of qubits it contains
+        self.circuit_model = circuit_model  # True for gate-based hardware
+        self.ports = None                   # Number of ports
+        self.ancillae = None                # Number of ancillary variables
+        self.interactions = None            # Number of quadratic terms
+        self.embedding = None               # Map from variables to chains
+        self.qubits = None                  # Physical qubits in all chains
+        self.max_chain_length = None        # Length of the longest chain
+        self.mean_chain_length = None       # Mean length of a chain
+
+    @property
+    def variables(self):
+        'Return the number of logical (QUBO) variables.'
+        return self.ports + self.ancillae
+
+    @property
+    def embedded(self):
+        'Return True if an embedding was found.'
+        return self.embedding is not None
+
+    @property
+    def fits(self):
+        '''Return True if the environment is expected to fit on the
+        target.'''
+        if self.circuit_model:
+            return self.variables <= self.target_qubits
+        return self.embedded
+
+    def __repr__(self):
+        ret = 'ResourceEstimate(target=%r, variables=%d, ports=%d, ' \
+            'ancillae=%d, interactions=%d, ' % \
+            (self.target, self.variables, self.ports, self.ancillae,
+             self.interactions)
+        if self.embedded:
+            ret += 'qubits=%d, max_chain_length=%d, ' \
+                'mean_chain_length=%.2f, ' % \
+                (self.qubits, self.max_chain_length, self.mean_chain_length)
+        return ret + 'fits=%s)' % self.fits
+
+
+def _as_topology(target, size):
+    '''Convert a topology name, a NetworkX graph, a list of edges, or a
+    structured dimod sampler to an object with nodelist and edgelist
+    attributes.'''
+    if isinstance(target, str):
+        return topology(target, size), target
+    if hasattr(target, 'nodelist') and hasattr(target, 'edgelist'):
+        return target, getattr(target, 'name', type(target).__name__)
+    if not isinstance(target, nx.Graph):
+        target = nx.Graph(list(target))
+    return Topology('custom', target), 'custom'
+
+
+def estimate(env, target='pegasus', size=None, circuit_model=None,
+             hard_scale=None, **minorminer_args):
+    '''Estimate the resources needed to solve an environment on a target
+    hardware graph, which can be a topology name ("chimera", "pegasus",
+    "zephyr", or "heavy-hex") with an optional size, a NetworkX graph, a
+    list of edges (e.g., a Qiskit coupling map), or a structured dimod
+    sampler.  circuit_model defaults to True only for "heavy-hex".
+    Embeddings are computed with minorminer, which receives
+    minorminer_args, and are cached, so a subsequent Ocean solve against
+    the same hardware graph reuses them.'''
+    topo, name = _as_topology(target, size)
+    if circuit_model is None:
+        circuit_model = target == 'heavy-hex'
+    qubo = construct_indexed_qubo(env, hard_scale)
+    ret = ResourceEstimate(name, len(topo.nodelist), circuit_model)
+    ret.ports = qubo.num_ports
+    ret.ancillae = qubo.num_vars - qubo.num_ports
+    ret.interactions = len(qubo.interactions())
+    try:
+        ret.embedding = embedding_cache.embedding(qubo, topo,
+                                                  **minorminer_args)
+    except ValueError:
+        return ret
+    lengths = [len(c) for c in ret.embedding.values()]
+    ret.qubits = sum(lengths)
+    ret.max_chain_length = max(lengths, default=0)
+    ret.mean_chain_length = ret.qubits/max(len(lengths), 1)
+    return ret
@@ -0,0 +1,250 @@
+########################################
+# Use vectorized simulated annealing   #
+# to solve for the variables in an     #
+# NchooseK environment                 #
+########################################
+
+from concurrent.futures import ProcessPoolExecutor
+from nchoosek import solver
+from nchoosek.solver import construct_indexed_qubo, local_search
+import datetime
+import numpy as np
+import os
+import time
+
+
+class Couplings(object):
+    '''Split a QUBO into linear biases and a symmetric matrix of couplings,
+    and partition its variables into color classes, no two members of which
+    are coupled.  Variables in the same class can be updated
+    simultaneously.'''
+
+    def __init__(self, qubo):
+        n = qubo.num_vars
+        diag = qubo.rows == qubo.cols
+        self.num_vars = n
+        self.linear = np.zeros(n)
+        np.add.at(self.linear, qubo.rows[diag], qubo.values[diag])
+        r, c, v = qubo.rows[~diag], qubo.cols[~diag], qubo.values[~diag]
+        full = solver.QUBO(qubo.names, qubo.num_ports,
+                           np.concatenate([r, c]), np.concatenate([c, r]),
+                           np.concatenate([v, v]).astype(np.float64))
+        self.coupling = full.to_sparse()
+        self.coupling.eliminate_zeros()
+        self.colors = self._color()
+
+    def _color(self):
+        'Greedily color the coupling graph.'
+        indptr = self.coupling.indptr
+        indices = self.coupling.indices
+        if self.num_vars == 0:
+            return []
+        color = np.full(self.num_vars, -1, dtype=np.int64)
+        order = np.argsort(-np.diff(indptr), kind='stable')
+        for i in order.tolist():
+            used = set(color[indices[indptr[i]:indptr[i + 1]]].tolist())
+            c = 0
+            while c in used:
+                c += 1
+            color[i] = c
+        return [np.flatnonzero(color == c) for c in range(color.max() + 1)]
+
+    def min_delta(self):
+        '''Return a lower bound on the smallest nonzero energy change from
+        flipping a single variable.  Every such change is a sum of
+        coefficients, so if all coefficients are integers, their greatest
+        common divisor is a lower bound.  Coefficients scaled by a hard
+        scale are typically much larger than that, so the smallest
+        coefficient is used only when some are not integers.'''
+        magnitudes = np.concatenate([np.abs(self.linear),
+                                     np.abs(self.coupling.data)])
+        magnitudes = magnitudes[magnitudes > 0]
+        if len(magnitudes) == 0:
+            return None
+        rounded = np.round(magnitudes)
+        if np.all(np.abs(magnitudes - rounded) <= 1e-9*magnitudes):
+            return float(np.gcd.reduce(rounded.astype(np.int64)))
+        return float(magnitudes.min())
+
+    def default_beta_range(self):
+        '''Return a (hot, cold) range of inverse temperatures in which
+        initially almost any flip and finally almost no uphill flip, even
+        the smallest, is accepted.'''
+        absc = abs(self.coupling)
+        max_delta = np.abs(self.linear) + np.asarray(absc.sum(axis=1)).ravel()
+        step = self.min_delta()
+        if step is None:
+            return 0.1, 1.0
+        hot = np.log(2)/max_delta.max()
+        cold = np.log(100)/step
+        return hot, max(cold, hot)
+
+
+def make_schedule(beta_range, num_sweeps, schedule):
+    '''Return an array of one inverse temperature per sweep.  schedule is
+    either "geometric", "linear", or an explicit sequence of inverse
+    temperatures, in which case beta_range and num_sweeps are ignored.'''
+    if not isinstance(schedule, str):
+        return np.asarray(schedule, dtype=np.float64)
+    hot, cold = beta_range
+    if schedule == 'geometric':
+        return np.geomspace(hot, cold, num_sweeps)
+    if schedule == 'linear':
+        return np.linspace(hot, cold, num_sweeps)
+    raise ValueError('unrecognized annealing schedule "%s"' % schedule)
+
+
+def _anneal(couplings, betas, num_reads, seed, deadline=None, initial=None):
+    '''Anneal num_reads replicas in parallel and return an (num_reads x
+    num_vars) matrix of final states.  Replicas start from the rows of
+    initial, if given, or from random states.  Stop early if the
+    time.time() deadline passes.  Every final state is a local minimum.'''
+    rng = np.random.default_rng(seed)
+    n = couplings.num_vars
+    if initial is None:
+        x = rng.integers(0, 2, size=(num_reads, n)).astype(np.float64)
+    else:
+        x = np.array(initial, dtype=np.float64)
+    field = x @ couplings.coupling + couplings.linear
+    # Transposed rows of the coupling matrix for each color class
+    rows = [couplings.coupling[cls].T.tocsr() for cls in couplings.colors]
+    for beta in betas:
+        if deadline is not None and time.time() > deadline:
+            break
+        for cls, coup in zip(couplings.colors, rows):
+            # Flipping x_i changes the energy by (1 - 2*x_i)*field_i.
+            xc = x[:, cls]
+            step = 1.0 - 2.0*xc
+            delta = step*field[:, cls]
+            accept = delta <= 0
+            uphill = ~accept
+            accept[uphill] = rng.random(np.count_nonzero(uphill)) < \
+                np.exp(-beta*delta[uphill])
+            flips = step*accept
+            x[:, cls] = xc + flips
+            field += (coup @ flips.T).T
+
+    # Finish with zero-temperature sweeps, which leave every replica in a
+    # local minimum: no single flip lowers its energy.
+    tol = 1e-9*max(1.0, np.abs(couplings.linear).max(initial=0.0))
+    changed = True
+    while changed:
+        changed = False
+        for cls, coup in zip(couplings.colors, rows):
+            xc = x[:, cls]
+            step = 1.0 - 2.0*xc
+            flips = step*(step*field[:, cls] < -tol)
+            if flips.any():
+                changed = True
+                x[:, cls] = xc + flips
+                field += (coup @ flips.T).T
+    return x.astype(np.int8)
+
+
+def _anneal_in_worker(args):
+    'Wrap _anneal for use with a process pool.'
+    return _anneal(*args)
+
+
+def _fit_schedule(couplings, betas, num_reads, time_limit):
+    '''Time a few sweeps, and thin a schedule so that it is likely to
+    complete within time_limit seconds.'''
+    start = time.time()
+    ntrial = min(10, len(betas))
+    _anneal(couplings, betas[:ntrial], num_reads, 0)
+    per_sweep = (time.time() - start)/max(ntrial, 1)
+    remaining = time_limit - (time.time() - start)
+    nsweeps = int(0.9*remaining/max(per_sweep, 1e-9))
+    if nsweeps >= len(betas):
+        return betas
+    # Keep the hottest and coldest temperatures.
+    keep = np.linspace(0, len(betas) - 1, max(nsweeps, 1))
+    return betas[np.round(keep).astype(np.int64)]
+
+
+def sample_qubo(qubo, num_reads=100, num_sweeps=1000, beta_range=None,
+                schedule='geometric', seed=None, num_workers=1,
+                time_limit=None, initial_states=None):
+    '''Sample a QUBO by simulated annealing and return an (num_reads x
+    num_vars) matrix of final states and a vector of their energies.  The
+    replicas are divided among num_workers processes (all cores if None).
+    If time_limit is given, reduce the number of sweeps to fit in that many
+    seconds.  If initial_states (an (n_states x num_vars) 0/1 matrix) is
+    given, the replicas start from its rows, cycling through them.'''
+    deadline = None
+    if time_limit is not None:
+        deadline = time.time() + time_limit
+    couplings = Couplings(qubo)
+    if beta_range is None:
+        beta_range = couplings.default_beta_range()
+    betas = make_schedule(beta_range, num_sweeps, schedule)
+
+    # Give each worker its own, independent random-number stream.
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, num_reads))
+    seeds = np.random.SeedSequence(seed).spawn(num_workers)
+    reads = [len(r) for r in np.array_split(np.arange(num_reads),
+                                            num_workers)]
+    initial = [None]*num_workers
+    if initial_states is not None:
+        initial_states = np.asarray(initial_states)
+        rows = np.arange(num_reads) % len(initial_states)
+        initial = np.array_split(initial_states[rows], num_workers)
+    if deadline is not None:
+        betas = _fit_schedule(couplings, betas, reads[0],
+                              deadline - time.time())
+    if num_workers == 1:
+        states = _anneal(couplings, betas, num_reads, seeds[0], deadline,
+                         initial[0])
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            parts = pool.map(_anneal_in_worker,
+                             [(couplings, betas, nr, sd, deadline, init)
+                              for nr, sd, init in zip(reads, seeds,
+                                                      initial)])
+            states = np.vstack(list(parts))
+    return states, qubo.energies(states)
+
+
+def solve(env, hard_scale=None, num_reads=100, num_sweeps=1000,
+          beta_range=None, schedule='geometric', seed=None, num_workers=1,
+          time_limit=None, polish=None, initial_solution=None):
+    '''Solve for the variables in a given NchooseK environment.  If polish
+    is "descent" or "tabu", improve each sample by that local search before
+    merging identical samples.  If initial_solution (one or more
+    {port name: Boolean} maps) is given, the replicas start from it and, by
+    default, anneal from a temperature near the cold end of the default
+    range (a tenth of the way from cold to hot on a log scale) so that they
+    search near the initial solution instead of forgetting it.'''
+    # Convert the environment to a QUBO.
+    qubo = construct_indexed_qubo(env, hard_scale).coalesce()
+    initial = None
+    if initial_solution is not None:
+        initial = local_search.initial_states(qubo, initial_solution)
+        if beta_range is None:
+            hot, cold = Couplings(qubo).default_beta_range()
+            beta_range = (hot**0.1*cold**0.9, cold)
+
+    # Anneal the QUBO.
+    time1 = datetime.datetime.now()
+    states, energies = sample_qubo(qubo, num_reads, num_sweeps, beta_range,
+                                   schedule, seed, num_workers, time_limit,
+                                   initial)
+    if polish is not None:
+        states, energies = local_search.polish(qubo, states, polish)
+
+    # Merge identical samples, and record the solutions, the number of
+    # occurrences, and the energies.
+    cenv = env.compile()
+    ret = solver.Result()
+    ret.samples = solver.SampleSet.from_samples(
+        cenv.ports, states[:, :qubo.num_ports], energies,
+        port_index=cenv.port_index)
+    time2 = datetime.datetime.now()
+    ret.times = (time1, time2)
+    ret.qubits = qubo.num_vars
+    timed_out = time_limit is not None and \
+        (time2 - time1).total_seconds() >= time_limit
+    ret.status = solver.sample_status(env, ret.samples, timed_out)
+    return ret
@@ -5,31 +5,202 @@
 ########################################
 
 from collections import defaultdict
+from nchoosek.solver.library import LibraryCache, TemplateLibrary
 import itertools
+import numpy as np
+import os
 import z3
 
+# Version of the QUBO encoding.  Increment this whenever a change to the
+# code would alter the templates it produces so that persistently stored
+# templates from older versions are no longer used.
+QUBO_ENCODING_VERSION = 3
+
+# Largest number of distinct ports for which solve_qubo will fall back to
+# searching over the full truth table.
+MAX_FULL_TABLE_COLUMNS = 10
+
+# Express common families of constraints (a single k, all-or-nothing, at
+# most one, and contiguous ranges of k) in closed form instead of searching
+# for a QUBO with Z3.
+USE_CLOSED_FORMS = True
+
+
+def _penalty_template(weights, const, shift=0):
+    '''Return a template for the penalty z*(z + shift), where z is the
+    weighted sum of the template's columns minus a constant.  The constant
+    term of the penalty is dropped.'''
+    n = len(weights)
+    qubo = [(i, i, w*w - 2*const*w + shift*w) for i, w in enumerate(weights)]
+    for i in range(n - 1):
+        for j in range(i + 1, n):
+            qubo.append((i, j, 2*weights[i]*weights[j]))
+    return qubo
+
+
+def template_excess(template, tallies, na):
+    '''Return the largest amount by which the energy of any assignment to a
+    template's ports, minimized over its ancillae, exceeds the template's
+    ground-state energy.  For a soft constraint, this bounds the penalty
+    for breaking it.  tallies gives the tally of each port column.
+    Templates for more than MAX_FULL_TABLE_COLUMNS ports assign equal
+    coefficients to ports of equal tally, so only one row per combination
+    of per-tally True counts is evaluated for them.'''
+    if len(template) == 0:
+        return 0
+    nc = len(tallies)
+    if nc <= MAX_FULL_TABLE_COLUMNS:
+        rows = list(itertools.product(*[[0, 1]]*nc))
+    else:
+        classes = [len(list(g)) for _, g in itertools.groupby(tallies)]
+        rows = []
+        for counts in itertools.product(*[range(n + 1) for n in classes]):
+            row = []
+            for n, m in zip(classes, counts):
+                row.extend([1]*m + [0]*(n - m))
+            rows.append(row)
+    ports = np.array(rows, dtype=np.int64).reshape(len(rows), nc)
+    anc = np.array(list(itertools.product(*[[0, 1]]*na)),
+                   dtype=np.int64).reshape(2**na, na)
+    states = np.hstack([np.repeat(ports, len(anc), axis=0),
+                        np.tile(anc, (len(ports), 1))])
+    tmpl = np.array(template)
+    energies = (states[:, tmpl[:, 0]]*states[:, tmpl[:, 1]]) @ tmpl[:, 2]
+    best = energies.reshape(len(ports), len(anc)).min(axis=1)
+    return (best.max() - best.min()).item()
+
+
+class QUBOCache(LibraryCache):
+    '''Cache of QUBO templates keyed on the canonical shape of a constraint.
+    A template is a list of (column, column, coefficient) triplets, where
+    columns number first the constraint's ports, in canonical order, and
+    then its ancillae.  Templates not found in memory are sought in an
+    optional, persistent TemplateLibrary.'''
+
+    noun = 'shapes'
+
+    def clear(self):
+        super().clear()
+        self._excess = {}
+
+    def _new_library(self, directory):
+        return TemplateLibrary(directory, QUBO_ENCODING_VERSION)
+
+    def store(self, shape, template, na):
+        'Associate a template and number of ancillae with a shape.'
+        self._excess.pop(shape, None)
+        super().store(shape, (template, na))
+
+    def excess(self, shape, template, na):
+        '''Return the template_excess of a shape's template, computing it
+        only once.'''
+        try:
+            return self._excess[shape]
+        except KeyError:
+            value = template_excess(template, shape[0], na)
+            self._excess[shape] = value
+            return value
+
+
+# Cache shared by all constraints in the process.  Setting the
+# NCHOOSEK_QUBO_LIBRARY environment variable to a directory name enables
+# persistent storage of templates in that directory.
+qubo_cache = QUBOCache()
+qubo_cache.use_library(os.getenv('NCHOOSEK_QUBO_LIBRARY'))
+
 
 class BQMMixin(object):
     'Mixin for an nchoosek.Constraint that converts the Constraint to a BQM'
 
-    def _truth_table(self):
-        "Convert a Constraint's ports to a truth table."
+    def _column_info(self):
+        '''Map each column number to a {port name, tally} pair.  Sorting by
+        tally first gives every constraint of a given shape the same column
+        order.'''
         # Tally the occurrences of each port name.
         port_tally = defaultdict(lambda: 0)
         for c in self.port_list:
             port_tally[c] += 1
+        return sorted([(p, port_tally[p]) for p in port_tally],
+                      key=lambda ci: (ci[1], ci[0]))
 
-        # Map each column number to a {port name, tally} pair.
-        col_info = [(p, port_tally[p])
-                    for i, p in enumerate(sorted(port_tally))]
-
+    def _truth_table(self):
+        "Convert a Constraint's ports to a truth table."
         # Return a truth table containing one column per unique port
         # name plus the per-column name and tally information
-        tt = itertools.product(*[[0, 1]]*len(port_tally))
+        col_info = self._column_info()
+        tt = itertools.product(*[[0, 1]]*len(col_info))
         return list(tt), col_info
 
+    def _shape(self, col_info):
+        '''Return a hashable representation of the constraint's shape: its
+        sorted tally profile and the achievable values of num_true.'''
+        tallies = tuple([ci[1] for ci in col_info])
+        total = sum(tallies)
+        return tallies, tuple(sorted([k for k in self.num_true
+                                      if 0 <= k <= total]))
+
+    def _closed_form(self, col_info):
+        '''Return a (template, number of ancillae) pair for constraints that
+        belong to a family with a known QUBO or None for all other
+        constraints.'''
+        weights = [ci[1] for ci in col_info]
+        nc = len(weights)
+
+        # Determine which weighted sums of True ports are achievable and
+        # which of those the constraint accepts.
+        sums = {0}
+        for w in weights:
+            sums |= {s + w for s in sums}
+        valid = sums & self.num_true
+
+        # Constraints that are always or never satisfied need no penalty.
+        if len(valid) == 0 or valid == sums:
+            return [(i, j, 0) for i, j, _ in _penalty_template(weights, 0)], 0
+
+        # Exactly k: (sum - k)^2.
+        if len(valid) == 1:
+            return _penalty_template(weights, valid.pop()), 0
+
+        # All False or all True: the sum over port pairs of (x_i - x_j)^2.
+        if valid == {0, max(sums)}:
+            qubo = [(i, i, nc - 1) for i in range(nc)]
+            for i in range(nc - 1):
+                for j in range(i + 1, nc):
+                    qubo.append((i, j, -2))
+            return qubo, 0
+
+        # At most one: the sum over port pairs of x_i*x_j.
+        if valid == {0, 1} and max(weights) == 1:
+            qubo = [(i, i, 0) for i in range(nc)]
+            for i in range(nc - 1):
+                for j in range(i + 1, nc):
+                    qubo.append((i, j, 1))
+            return qubo, 0
+
+        # The remaining family comprises contiguous ranges, a <= sum <= b.
+        # z*(z - 1) is zero only for z in {0, 1}, so with z = sum - a - 2*u
+        # and u encoded in binary by the ancillae, each valid sum has
+        # exactly one ground state.  Alternatively, z*(z + 1) with z = sum -
+        # b + 2*u counts down from b.  Either form works as long as the
+        # ancillae cannot reach the nearest invalid sum on the far side.
+        a, b = min(valid), max(valid)
+        if any(s not in valid for s in sums if a <= s <= b):
+            return None
+        below = [s for s in sums if s < a]
+        above = [s for s in sums if s > b]
+        na = ((b - a)//2).bit_length()
+        reach = 2**(na + 1)
+        anc = [2**(k + 1) for k in range(na)]
+        if len(above) == 0 or min(above) - a >= reach:
+            return _penalty_template(weights + [-u for u in anc], a, -1), na
+        if len(below) == 0 or b - max(below) >= reach:
+            return _penalty_template(weights + anc, b, 1), na
+        return None
+
     def _solve_ancillae(self, tt, col_info, na):
-        'Solve for QUBO coefficients given a number of ancillae.'
+        '''Solve for QUBO coefficients given a number of ancillae.  Return a
+        list of (column, column, coefficient) triplets or None if no
+        solution exists.'''
         nc = len(col_info)     # Number of columns, no ancillae
         tnc = nc + na          # Total number of columns including ancillae
 
@@ -82,31 +253,205 @@ class BQMMixin(object):
             return None
         model = s.model()
 
-        # Convert the model to a QUBO, represented as a list of (port1, port2,
-        # coefficient) triplets.  For linear terms, port1 == port2.
+        # Convert the model to a QUBO, represented as a list of (column1,
+        # column2, coefficient) triplets.  For linear terms, column1 ==
+        # column2.
         qubo = []
-        port_names = [ci[0]
-                      for ci in col_info] + ['_anc%d' % (i + 1)
-                                             for i in range(na)]
         for i in range(tnc):
-            nm = port_names[i]
             val = model[cf[i]].as_long()
-            qubo.append((nm, nm, val))
+            qubo.append((i, i, val))
         idx = tnc
         for i in range(tnc - 1):
             for j in range(i + 1, tnc):
                 val = model[cf[idx]].as_long()
-                qubo.append((port_names[i], port_names[j], val))
+                qubo.append((i, j, val))
                 idx += 1
         return qubo
 
-    def solve_qubo(self):
-        '''Try increasing numbers of ancillae until the truth table can be
-        expressed in terms of a QUBO's linear and quadratic coefficients.'''
-        tt, col_info = self._truth_table()
+    def _solve_ancillae_symmetric(self, col_info, na):
+        '''Solve for QUBO coefficients given a number of ancillae, requiring
+        all ports with the same tally to share coefficients.  Because a
+        constraint depends only on how many ports of each tally are True,
+        this needs one row per combination of per-tally counts rather than
+        one row per truth-table row.  Return a list of (column, column,
+        coefficient) triplets or None if no such solution exists.'''
+        # Partition the columns into classes of equal tally.  col_info is
+        # sorted by tally, so each class is a contiguous range of columns.
+        classes = []    # [tally, number of columns]
+        col_class = []  # Class of each column
+        for _, tally in col_info:
+            if len(classes) == 0 or classes[-1][0] != tally:
+                classes.append([tally, 0])
+            classes[-1][1] += 1
+            col_class.append(len(classes) - 1)
+        ncls = len(classes)
+
+        # Declare a Z3 variable for each per-class coefficient, for each
+        # ancilla coefficient, and for the ground-state constant.
+        lin = [z3.Int('a_c%d' % c) for c in range(ncls)]
+        quad = {}
+        for c in range(ncls):
+            for d in range(c, ncls):
+                quad[(c, d)] = z3.Int('b_c%d_c%d' % (c, d))
+        anc_lin = [z3.Int('a_anc%d' % k) for k in range(na)]
+        anc_cls = {}
+        for c in range(ncls):
+            for k in range(na):
+                anc_cls[(c, k)] = z3.Int('b_c%d_anc%d' % (c, k))
+        anc_quad = {}
+        for k in range(na - 1):
+            for l in range(k + 1, na):
+                anc_quad[(k, l)] = z3.Int('b_anc%d_anc%d' % (k, l))
+        const = z3.Int('k')
+        s = z3.Solver()
+
+        # Consider in turn each combination of per-class True counts.
+        for counts in itertools.product(*[range(cl[1] + 1) for cl in classes]):
+            # Compute the contribution of the ports alone.  m True ports in a
+            # class contribute m*(m - 1)/2 intra-class products.
+            e_ports = 0
+            for c in range(ncls):
+                e_ports += lin[c]*counts[c]
+                e_ports += quad[(c, c)]*(counts[c]*(counts[c] - 1)//2)
+                for d in range(c + 1, ncls):
+                    e_ports += quad[(c, d)]*counts[c]*counts[d]
+
+            # Construct a Z3 expression for each combination of ancillae.
+            exprs = []
+            for anc in itertools.product(*[[0, 1]]*na):
+                e = e_ports
+                for k in range(na):
+                    if anc[k] == 0:
+                        continue
+                    e += anc_lin[k]
+                    for c in range(ncls):
+                        e += anc_cls[(c, k)]*counts[c]
+                    for l in range(k + 1, na):
+                        e += anc_quad[(k, l)]*anc[l]
+                exprs.append(z3.simplify(e))
+
+            # Constrain the expressions exactly as in _solve_ancillae.
+            valid = sum([cl[0]*m
+                         for cl, m in zip(classes, counts)]) in self.num_true
+            if valid:
+                s.add(z3.PbEq([(e == const, 1) for e in exprs], 1))
+                s.add(z3.PbEq([(e > const, 1) for e in exprs], len(exprs) - 1))
+            else:
+                for e in exprs:
+                    s.add(e > const)
+
+        # Solve the Z3 model.
+        if s.check() != z3.sat:
+            return None
+        model = s.model()
+
+        # Expand the per-class coefficients to a per-column QUBO, ordered
+        # the same as the one returned by _solve_ancillae.
+        def coeff(c, d):
+            return model[quad[(c, d)]].as_long()
+
+        nc = len(col_info)
+        tnc = nc + na
+        qubo = []
+        for i in range(nc):
+            qubo.append((i, i, model[lin[col_class[i]]].as_long()))
+        for k in range(na):
+            qubo.append((nc + k, nc + k, model[anc_lin[k]].as_long()))
+        for i in range(tnc - 1):
+            for j in range(i + 1, tnc):
+                if j < nc:
+                    val = coeff(col_class[i], col_class[j])
+                elif i < nc:
+                    val = model[anc_cls[(col_class[i], j - nc)]].as_long()
+                else:
+                    val = model[anc_quad[(i - nc, j - nc)]].as_long()
+                qubo.append((i, j, val))
+        return qubo
+
+    def qubo_template(self, col_info=None):
+        '''Return a QUBO template for the constraint, the list of port names
+        corresponding to the template's leading columns, and the number of
+        ancillae.  The template is None if the constraint cannot be
+        expressed as a QUBO.  Constraints of the same shape share a single,
+        cached template.  Callers that have already tallied the ports can
+        pass in a list of (port, tally) pairs sorted by tally then port, in
+        which case any port identifiers, such as indices, can be used in
+        place of port names.'''
+        if col_info is None:
+            col_info = self._column_info()
+        port_names = [ci[0] for ci in col_info]
+        shape = self._shape(col_info)
+        entry = qubo_cache.lookup(shape)
+        if entry is not None:
+            return entry[0], port_names, entry[1]
+
+        # Use a closed-form QUBO if one is available.
+        if USE_CLOSED_FORMS:
+            entry = self._closed_form(col_info)
+            if entry is not None:
+                qubo_cache.store(shape, entry[0], entry[1])
+                return entry[0], port_names, entry[1]
+
+        # Try increasing numbers of ancillae until the truth table can be
+        # expressed in terms of a QUBO's linear and quadratic coefficients.
+        # For each number of ancillae, first try the much smaller symmetric
+        # formulation then, if the constraint is small enough, the full
+        # truth table.
         nc = len(col_info)
+        tt = None
+        if nc <= MAX_FULL_TABLE_COLUMNS:
+            tt, _ = self._truth_table()
+        template = None
+        na = 0
         for na in range(0, nc):
-            soln = self._solve_ancillae(tt, col_info, na)
-            if soln is not None:
-                return soln, na
-        return None, na
+            template = self._solve_ancillae_symmetric(col_info, na)
+            if template is None and tt is not None:
+                template = self._solve_ancillae(tt, col_info, na)
+            if template is not None:
+                break
+        qubo_cache.store(shape, template, na)
+        return template, port_names, na
+
+    def solve_qubo(self):
+        '''Return the constraint as a list of (port1, port2, coefficient)
+        triplets plus the number of ancillae required.  The list is None if
+        the constraint cannot be expressed as a QUBO.'''
+        template, port_names, na = self.qubo_template()
+        if template is None:
+            return None, na
+        names = port_names + ['_anc%d' % (i + 1) for i in range(na)]
+        return [(names[i], names[j], val) for i, j, val in template], na
+
+    def check_qubo(self):
+        '''Return True if the constraint's QUBO honors its truth table: for
+        each valid row, exactly one assignment to the ancillae attains the
+        ground-state energy, and every assignment for an invalid row lies
+        above it.  This is exponential in the number of ports and ancillae
+        and is intended only for testing.'''
+        template, _, na = self.qubo_template()
+        if template is None:
+            return False
+        tt, col_info = self._truth_table()
+        valid_rows = []
+        invalid_rows = []
+        for row in tt:
+            energies = []
+            for anc in itertools.product(*[[0, 1]]*na):
+                ext_row = list(row) + list(anc)
+                energies.append(sum([val*ext_row[i]*ext_row[j]
+                                     for i, j, val in template]))
+            if sum([b*col_info[i][1]
+                    for i, b in enumerate(row)]) in self.num_true:
+                valid_rows.append(energies)
+            else:
+                invalid_rows.append(energies)
+        if len(valid_rows) == 0:
+            return True
+        ground = min([min(es) for es in valid_rows])
+        for es in valid_rows:
+            if min(es) != ground or es.count(ground) != 1:
+                return False
+        for es in invalid_rows:
+            if min(es) <= ground:
+                return False
+        return True
@@ -3,8 +3,9 @@
 # common across multiple solvers        #
 #########################################
 
-from collections import defaultdict
-import re
+from collections.abc import Mapping, Sequence
+import numpy as np
+import scipy.sparse
 
 
 class ConstraintConversionError(Exception):
@@ -15,58 +16,351 @@ class ConstraintConversionError(Exception):
         super().__init__(msg)
 
 
-def rename_ancilla(name, inc):
-    'Rename _ancN with _anc(N+inc).'
-    if name[:4] != '_anc':
-        return name
-    num = int(name[4:])
-    return '_anc%d' % (num + inc)
+class QUBO(object):
+    '''QUBO over integer-numbered variables, stored in coordinate (COO) form
+    as parallel arrays of row indices, column indices, and coefficients
+    with row <= column.  Variables 0 to num_ports - 1 are the ports of a
+    compiled environment, in the same order; the remaining variables are
+    ancillae.  The same (row, column) pair may appear more than once, in
+    which case the coefficients are summed.'''
 
+    def __init__(self, names, num_ports, rows, cols, values):
+        self.names = names
+        self.num_ports = num_ports
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+
+    @property
+    def num_vars(self):
+        'Return the total number of variables, including ancillae.'
+        return len(self.names)
+
+    def interactions(self):
+        '''Return a sorted list of the distinct (i, j) pairs, i < j, of
+        variables that interact.'''
+        off = self.rows != self.cols
+        keys = np.unique(self.rows[off].astype(np.int64)*self.num_vars +
+                         self.cols[off])
+        return list(zip((keys//self.num_vars).tolist(),
+                        (keys % self.num_vars).tolist()))
+
+    def coalesce(self):
+        '''Return an equivalent QUBO in which each (row, column) pair
+        appears only once, sorted by row then column.'''
+        n = self.num_vars
+        keys = self.rows.astype(np.int64)*n + self.cols
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        values = np.zeros(len(uniq), dtype=self.values.dtype)
+        np.add.at(values, inverse.reshape(-1), self.values)
+        return QUBO(self.names, self.num_ports, uniq//n, uniq % n, values)
+
+    def to_sparse(self):
+        '''Return the QUBO as an upper-triangular SciPy CSR matrix.'''
+        n = self.num_vars
+        return scipy.sparse.coo_matrix((self.values, (self.rows, self.cols)),
+                                       shape=(n, n)).tocsr()
+
+    def to_dict(self):
+        '''Return the QUBO as a mapping from (name, name) pairs to
+        coefficients.'''
+        qubo = self.coalesce()
+        names = self.names
+        return {(names[r], names[c]): v
+                for r, c, v in zip(qubo.rows.tolist(), qubo.cols.tolist(),
+                                   qubo.values.tolist())}
+
+    def to_bqm(self):
+        '''Return the QUBO as a dimod BinaryQuadraticModel whose variables
+        are named.'''
+        import dimod
+        diag = self.rows == self.cols
+        linear = np.zeros(self.num_vars, dtype=np.float64)
+        np.add.at(linear, self.rows[diag], self.values[diag])
+        quad = (self.rows[~diag], self.cols[~diag], self.values[~diag])
+        return dimod.BinaryQuadraticModel.from_numpy_vectors(
+            linear, quad, 0.0, dimod.BINARY, variable_order=self.names)
+
+    def energies(self, states):
+        '''Return the energy of each row of an (n_states x num_vars) 0/1
+        matrix.'''
+        states = np.asarray(states, dtype=np.float64)
+        return np.asarray((states @ self.to_sparse()) * states).sum(axis=1)
+
+
+def soft_penalties(env):
+    '''Return a map from the index of each soft constraint in a compiled
+    environment to the largest excess energy of its QUBO template: the
+    most that breaking the constraint can cost per unit of weight.  This
+    can exceed 1 (e.g., (x - k)^2 grows quadratically), in which case QUBO
+    ground states need not break the fewest soft constraints.'''
+    from nchoosek.solver import bqm
+    cenv = env.compile()
+    penalties = {}
+    for i in np.flatnonzero(cenv.soft).tolist():
+        c = cenv.constraints[i]
+        col_info = cenv.column_info(i)
+        template, _, na = c.qubo_template(col_info)
+        if template is None:
+            raise ConstraintConversionError(str(c))
+        penalties[i] = bqm.qubo_cache.excess(c._shape(col_info), template,
+                                             na)
+    return penalties
+
+
+def default_hard_scale(env):
+    '''Return a weight for hard constraints that exceeds the largest
+    possible total penalty of all soft constraints (see
+    soft_penalties).'''
+    cenv = env.compile()
+    return 1 + sum([cenv.weights[i].item()*p
+                    for i, p in soft_penalties(env).items()])
+
+
+def construct_indexed_qubo(env, hard_scale):
+    '''Convert an entire environment to a QUBO over integer-numbered
+    variables.'''
+    cenv = env.compile()
 
-def construct_qubo(env, hard_scale):
-    'Convert an entire environment to a QUBO.'
     # Scale the weight of hard constraints by either a user-specified
-    # value or by an amount greater than the total weight of all soft
-    # constraints.
+    # value or by an amount greater than the largest total penalty of all
+    # soft constraints.
     if hard_scale is None:
-        # A hard constraint is worth 1 more than all soft constraints combined.
-        hard_scale = 1
-        for c in env.constraints():
-            if c.soft:
-                hard_scale += 1
-
-    # Merge all constraints into a single, large QUBO.
-    qubo = defaultdict(lambda: 0)
+        hard_scale = default_hard_scale(env)
+
+    # Group the constraints by shape so that each shape's template can be
+    # applied to all constraints of that shape at once.
+    groups = {}   # Map from a shape to [template, #ancillae, ports, scales]
+    for i, c in enumerate(cenv.constraints):
+        col_info = cenv.column_info(i)
+        shape = c._shape(col_info)
+        grp = groups.get(shape)
+        if grp is None:
+            template, _, na = c.qubo_template(col_info)
+            if template is None:
+                raise ConstraintConversionError(str(c))
+            grp = [template, na, [], []]
+            groups[shape] = grp
+        grp[2].append([ci[0] for ci in col_info])
+        grp[3].append(cenv.weights[i].item() if c.soft else hard_scale)
+
+    # Instantiate each group's template for each of its constraints,
+    # allocating new ancillae as we go.
+    rows = []
+    cols = []
+    values = []
     total_anc = 0   # Total number of ancillae across all constraints
-    for c in env.constraints():
-        qqv, _ = c.solve_qubo()
-        if qqv is None:
-            raise ConstraintConversionError(str(c))
-        for q1, q2, val in qqv:
-            if not c.soft:
-                val *= hard_scale
-            q1 = rename_ancilla(q1, total_anc)
-            q2 = rename_ancilla(q2, total_anc)
-            qubo[(q1, q2)] += val
-        total_anc += len({a for a in [q1, q2] if a[:4] == '_anc'})
-    return qubo
+    for template, na, ports, scales in groups.values():
+        if len(template) == 0:
+            continue
+        ports = np.array(ports, dtype=np.int64).reshape(len(scales), -1)
+        anc = cenv.num_ports + total_anc + \
+            np.arange(len(scales)*na, dtype=np.int64).reshape(len(scales), na)
+        total_anc += len(scales)*na
+        colmap = np.hstack([ports, anc])
+        tmpl = np.array(template)
+        r = colmap[:, tmpl[:, 0]].ravel()
+        c = colmap[:, tmpl[:, 1]].ravel()
+        rows.append(np.minimum(r, c))
+        cols.append(np.maximum(r, c))
+        values.append((np.array(scales)[:, None]*tmpl[:, 2]).ravel())
+    if len(rows) == 0:
+        rows = cols = values = [np.zeros(0, dtype=np.int64)]
+    names = list(cenv.ports) + ['_anc%d' % (i + 1) for i in range(total_anc)]
+    return QUBO(names, cenv.num_ports, np.concatenate(rows),
+                np.concatenate(cols), np.concatenate(values))
+
+
+def construct_qubo(env, hard_scale):
+    '''Convert an entire environment to a QUBO, represented as a mapping
+    from pairs of variable names to coefficients.'''
+    return construct_indexed_qubo(env, hard_scale).to_dict()
+
+
+class SolutionView(Mapping):
+    '''Read-only mapping from port names to Booleans for one sample in a
+    SampleSet.  Values are extracted from the packed bits on demand.'''
+
+    def __init__(self, samples, row):
+        self._samples = samples
+        self._row = row
+
+    def __getitem__(self, port):
+        idx = self._samples.port_index[port]
+        byte = self._samples.bits[self._row, idx >> 3]
+        return bool((byte >> (7 - (idx & 7))) & 1)
+
+    def __iter__(self):
+        return iter(self._samples.ports)
+
+    def __len__(self):
+        return len(self._samples.ports)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class SampleSet(Sequence):
+    '''Compact collection of solutions stored as a packed bit array with one
+    row per sample and one column per port, plus per-sample tallies and
+    energies.  Indexing yields a SolutionView, which behaves like the
+    {port name: Boolean} dictionaries used elsewhere.'''
+
+    def __init__(self, ports, samples, tallies=None, energies=None,
+                 port_index=None):
+        '''Construct a SampleSet from a sequence of port names and an
+        (n_samples x n_ports) 0/1 matrix.  port_index, if provided, must map
+        each port name to its position in ports.'''
+        samples = np.asarray(samples, dtype=bool)
+        if samples.ndim != 2:
+            samples = samples.reshape(-1, len(ports))
+        self.ports = tuple(ports)
+        if port_index is None:
+            port_index = {p: i for i, p in enumerate(self.ports)}
+        self.port_index = port_index
+        self.bits = np.packbits(samples, axis=1)
+        if tallies is None:
+            tallies = np.ones(len(samples), dtype=np.int64)
+        self.tallies = np.asarray(tallies)
+        if energies is not None:
+            energies = np.asarray(energies)
+        self.energies = energies
+
+    @classmethod
+    def from_samples(cls, ports, samples, energies=None, tallies=None,
+                     port_index=None):
+        '''Construct a SampleSet from an (n_samples x n_ports) 0/1 matrix
+        that may contain repeated rows, optionally with a per-row energy
+        and tally.  Repeated rows are merged into a single sample whose
+        tally is the sum of the rows' tallies, and samples are sorted by
+        increasing energy (or decreasing tally if no energies are
+        given).'''
+        samples = np.asarray(samples, dtype=bool)
+        if samples.ndim != 2:
+            samples = samples.reshape(-1, len(ports))
+        packed = np.packbits(samples, axis=1)
+        _, first, inverse = np.unique(packed, axis=0, return_index=True,
+                                      return_inverse=True)
+        inverse = inverse.reshape(-1)
+        if tallies is None:
+            tallies = np.bincount(inverse, minlength=len(first))
+        else:
+            tallies = np.bincount(inverse, weights=tallies,
+                                  minlength=len(first)).astype(np.int64)
+        if energies is not None:
+            # Samples that differ only in variables other than ports (e.g.,
+            # ancillae) are merged; keep the lowest energy.
+            merged = np.full(len(first), np.inf)
+            np.minimum.at(merged, inverse, np.asarray(energies))
+            order = np.lexsort((-tallies, merged))
+            energies = merged[order]
+        else:
+            order = np.argsort(-tallies, kind='stable')
+        return cls(ports, samples[first[order]], tallies[order], energies,
+                   port_index)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('sample index out of range')
+        return SolutionView(self, i)
+
+    def __repr__(self):
+        return repr([dict(s) for s in self])
+
+    def array(self, ports=None):
+        '''Return the samples as an (n_samples x n_ports) 0/1 matrix whose
+        columns are ordered as in a given sequence of port names (default:
+        self.ports).'''
+        arr = np.unpackbits(self.bits, axis=1, count=len(self.ports))
+        if ports is None or tuple(ports) == self.ports:
+            return arr
+        return arr[:, [self.port_index[p] for p in ports]]
+
+
+def sample_status(env, samples, timed_out=False):
+    '''Return the status of a heuristic solver's samples: "feasible" if any
+    sample satisfies all hard constraints, otherwise "timeout" if the solver
+    ran out of time or "infeasible" if not.'''
+    if len(samples) > 0:
+        hard_failed, _ = env.batch_validation(samples)
+        if (hard_failed == 0).any():
+            return 'feasible'
+    if timed_out:
+        return 'timeout'
+    return 'infeasible'
 
 
 class Result(object):
-    'Encapsulate solver results and related data.'
+    '''Encapsulate solver results and related data.  status is one of
+    "optimal" (the top solution is provably optimal), "feasible" (some
+    solution satisfies all hard constraints), "timeout" (the time limit
+    expired before any solution satisfying all hard constraints was found),
+    or "infeasible" (no solution satisfying all hard constraints exists or,
+    for heuristic solvers, none was found).  A Result is false if its status
+    is "timeout" or "infeasible".'''
 
     def __init__(self):
-        self.solutions = None
-        self.tallies = None
-        self.energies = None
+        self.status = None
+        self.samples = None
+        self._solutions = None
+        self._tallies = None
+        self._energies = None
         self.jobIDs = None
         self.qubits = None
         self.depth = None
+        self.two_qubit_gates = None
+        self.swaps = None
         self.times = None
         self.quantum_instance = None
+        self.bounds = None
+
+    # When a Result is backed by a SampleSet, solutions, tallies, and
+    # energies are derived from it unless explicitly overridden.
+    @property
+    def solutions(self):
+        if self._solutions is None and self.samples is not None:
+            return self.samples
+        return self._solutions
+
+    @solutions.setter
+    def solutions(self, value):
+        self._solutions = value
+
+    @property
+    def tallies(self):
+        if self._tallies is None and self.samples is not None:
+            return self.samples.tallies.tolist()
+        return self._tallies
+
+    @tallies.setter
+    def tallies(self, value):
+        self._tallies = value
+
+    @property
+    def energies(self):
+        if self._energies is None and self.samples is not None and \
+           self.samples.energies is not None:
+            return self.samples.energies.tolist()
+        return self._energies
+
+    @energies.setter
+    def energies(self, value):
+        self._energies = value
+
+    def __bool__(self):
+        return self.status not in ['timeout', 'infeasible']
 
     def __repr__(self):
         ret = {}
+        if self.status:
+            ret["status"] = self.status
         if self.solutions:
            ret["top solution"] = self.solutions[0]
            ret["number of solutions"] = len(self.solutions)
@@ -78,6 +372,12 @@ class Result(object):
             ret["qubits"] = self.qubits
         if self.depth:
             ret["depth"] = self.depth
+        if self.two_qubit_gates:
+            ret["two-qubit gates"] = self.two_qubit_gates
+        if self.swaps is not None:
+            ret["swaps"] = self.swaps
+        if self.bounds:
+            ret["broken soft weight bounds"] = self.bounds
         if self.times:
             ret["times"] = (self.times[0].strftime("%Y-%m-%d %H:%M:%S.%f"), self.times[1].strftime("%Y-%m-%d %H:%M:%S.%f"))
         if self.quantum_instance:
@@ -86,27 +386,16 @@ class Result(object):
         return str(ret)
 
     def details(self):
-        if self.quantum_instance:
-            try:
-                device = self.quantum_instance.backend
-                print(device)
-                print(self.times[0])
-                print(self.times[1])
-                jobs = device.jobs(limit=50, start_datetime=self.times[0], end_datetime=self.times[1])
-                print(jobs)
-                qasm = jobs[2].circuits()[0].qasm()
-                print(qasm)
-                count = 0
-                # Qiskit jobs don't tell you how many physical qubits get used;
-                # we need to search through the final qasm.
-                for i in range(device.configuration().n_qubits):
-                    if re.search(r"cx[^;]*q\[" + str(i) + r"\]", qasm) or re.search(r"rz\([^\(]*\) q\[" + str(i) + r"\]", qasm):
-                        count += 1
-
-                self.jobIDs = []
-                for job in jobs:
-                    self.jobIDs.append(job.job_id())
-                self.qubits = count
-                self.depth = jobs[2].circuits()[0].depth()
-            except:
-                pass
+        '''Record the IDs of the jobs a Qiskit solve submitted to its
+        backend.  Circuit metrics (qubits, depth, two_qubit_gates, and
+        swaps) are computed locally when the problem is solved.'''
+        if not self.quantum_instance:
+            return
+        device = self.quantum_instance.backend
+        try:
+            jobs = device.jobs(limit=50, start_datetime=self.times[0],
+                               end_datetime=self.times[1])
+        except AttributeError:
+            # Local simulators keep no job history.
+            return
+        self.jobIDs = [job.job_id() for job in jobs]
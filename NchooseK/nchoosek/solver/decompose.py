@@ -0,0 +1,184 @@
+########################################
+# Solve large NchooseK environments by #
+# repeatedly solving small pieces of   #
+# their QUBOs (in the style of qbsolv) #
+########################################
+
+from nchoosek import solver
+from nchoosek.solver import construct_indexed_qubo, local_search
+from nchoosek.solver.anneal import Couplings
+import datetime
+import importlib
+import numpy as np
+import time
+
+# Default arguments for each inner solver's sample_qubo function
+_INNER_DEFAULTS = {
+    'anneal': {'num_reads': 10, 'num_sweeps': 200},
+    'exact': {},
+    'ocean': {},
+    'qiskit': {},
+}
+
+
+class _State(object):
+    '''Incumbent assignment to all QUBO variables, plus each variable's
+    local field (the energy change from setting it to 1, given the other
+    variables).'''
+
+    def __init__(self, couplings, x):
+        self.couplings = couplings
+        self.x = np.asarray(x, dtype=np.float64)
+        self.field = couplings.coupling @ self.x + couplings.linear
+
+    def energy(self):
+        'Return the energy of the current assignment.'
+        return float(self.x @ (self.couplings.linear + self.field)/2)
+
+    def deltas(self):
+        'Return the energy change from flipping each variable.'
+        return (1.0 - 2.0*self.x)*self.field
+
+    def assign(self, idxs, values):
+        'Set the variables with the given indices to the given values.'
+        change = values - self.x[idxs]
+        moved = change != 0
+        if not moved.any():
+            return
+        idxs, change = idxs[moved], change[moved]
+        self.x[idxs] += change
+        self.field += self.couplings.coupling[:, idxs] @ change
+
+    def descend(self):
+        'Flip single variables until no flip lowers the energy.'
+        while True:
+            deltas = self.deltas()
+            i = int(np.argmin(deltas))
+            if deltas[i] >= 0:
+                return
+            self.assign(np.array([i]), np.array([1.0 - self.x[i]]))
+
+    def neighborhood(self, seed, size, rank):
+        '''Return the indices of up to size variables reachable from a seed
+        variable through the coupling graph, preferring variables with a
+        lower rank.'''
+        indptr = self.couplings.coupling.indptr
+        indices = self.couplings.coupling.indices
+        chosen = {seed}
+        frontier = {}
+        node = seed
+        while len(chosen) < size:
+            for j in indices[indptr[node]:indptr[node + 1]].tolist():
+                if j not in chosen:
+                    frontier[j] = rank[j]
+            if len(frontier) == 0:
+                break
+            node = min(frontier, key=frontier.get)
+            del frontier[node]
+            chosen.add(node)
+        return np.array(sorted(chosen), dtype=np.int64)
+
+    def subqubo(self, idxs):
+        '''Return the QUBO over the given variables obtained by clamping all
+        other variables to their current values.'''
+        cp = self.couplings
+        sub = cp.coupling[idxs][:, idxs].tocoo()
+        upper = sub.row < sub.col
+        # Interactions with the clamped variables become linear terms.
+        linear = self.field[idxs] - sub @ self.x[idxs]
+        n = len(idxs)
+        rows = np.concatenate([np.arange(n), sub.row[upper]])
+        cols = np.concatenate([np.arange(n), sub.col[upper]])
+        values = np.concatenate([linear, sub.data[upper]])
+        names = ['_sub%d' % i for i in range(n)]
+        return solver.QUBO(names, n, rows, cols, values)
+
+
+def solve(env, inner='anneal', sub_size=20, max_passes=100, patience=3,
+          hard_scale=None, seed=None, time_limit=None, initial_solution=None,
+          **inner_args):
+    '''Solve for the variables in a given NchooseK environment by
+    repeatedly selecting sub_size coupled QUBO variables, starting from the
+    variables whose flips would most improve (or least worsen) the energy,
+    clamping the remaining variables to the incumbent solution, and
+    minimizing the resulting sub-QUBO with the inner solver ("anneal",
+    "exact", "ocean", or "qiskit"), which receives inner_args.  Stop after
+    max_passes passes over all variables or after patience passes without
+    improvement.  The incumbent starts from the lowest-energy state of
+    initial_solution (one or more {port name: Boolean} maps), if given.'''
+    if inner not in _INNER_DEFAULTS:
+        raise ValueError('"%s" cannot be used as an inner solver' % inner)
+    sample_qubo = importlib.import_module('nchoosek.solver.' +
+                                          inner).sample_qubo
+    args = dict(_INNER_DEFAULTS[inner])
+    args.update(inner_args)
+    if inner == 'ocean' and args.get('sampler') is None:
+        # Reuse a single sampler for all sub-QUBOs.
+        import nchoosek.solver.ocean
+        args['sampler'] = nchoosek.solver.ocean.default_sampler()
+    if inner == 'anneal' and 'seed' not in args:
+        args['seed'] = seed
+
+    # Convert the environment to a QUBO, and start from the initial
+    # solution or a random state, improved by greedy descent.
+    qubo = construct_indexed_qubo(env, hard_scale).coalesce()
+    time1 = datetime.datetime.now()
+    deadline = None
+    if time_limit is not None:
+        deadline = time.time() + time_limit
+    rng = np.random.default_rng(seed)
+    couplings = Couplings(qubo)
+    if initial_solution is not None:
+        initial = local_search.initial_states(qubo, initial_solution)
+        x = initial[np.argmin(qubo.energies(initial))]
+    else:
+        x = rng.integers(0, 2, size=qubo.num_vars)
+    state = _State(couplings, x)
+    state.descend()
+    best = state.energy()
+
+    # Repeatedly improve the incumbent one sub-QUBO at a time.
+    timed_out = False
+    stale = 0
+    for _ in range(max_passes):
+        # Visit every variable once per pass, highest impact first.
+        order = np.argsort(state.deltas(), kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        visited = np.zeros(len(order), dtype=bool)
+        for seed in order.tolist():
+            if visited[seed]:
+                continue
+            if deadline is not None and time.time() > deadline:
+                timed_out = True
+                break
+            idxs = state.neighborhood(seed, sub_size, rank)
+            visited[idxs] = True
+            sub = state.subqubo(idxs)
+            current = sub.energies(state.x[idxs].reshape(1, -1))[0]
+            states, energies = sample_qubo(sub, **args)
+            i = int(np.argmin(energies))
+            if energies[i] < current:
+                state.assign(idxs, states[i].astype(np.float64))
+        state.descend()
+        energy = state.energy()
+        if energy < best - 1e-9*max(1.0, abs(best)):
+            best = energy
+            stale = 0
+        else:
+            stale += 1
+        if timed_out or stale >= patience:
+            break
+
+    # Return the incumbent.
+    cenv = env.compile()
+    x = state.x.astype(np.int8)
+    ret = solver.Result()
+    ret.samples = solver.SampleSet(cenv.ports, x[:qubo.num_ports],
+                                   energies=[state.energy()],
+                                   port_index=cenv.port_index)
+    time2 = datetime.datetime.now()
+    ret.times = (time1, time2)
+    ret.qubits = min(sub_size, qubo.num_vars)
+    ret.status = solver.sample_status(env, ret.samples, timed_out)
+    return ret
@@ -0,0 +1,270 @@
+########################################
+# Cache minor embeddings of QUBOs into #
+# quantum hardware graphs              #
+########################################
+
+from nchoosek.solver.common import QUBO
+from nchoosek.solver.library import EmbeddingLibrary, LibraryCache
+import hashlib
+import json
+import minorminer
+import networkx as nx
+import numpy as np
+import os
+
+# Default size of each named hardware topology: a D-Wave 2000Q (Chimera),
+# a D-Wave Advantage (Pegasus), an Advantage2 prototype (Zephyr), and a
+# heavy-hex lattice of 111 qubits, roughly the size of an IBM Eagle.
+DEFAULT_TOPOLOGY_SIZES = {
+    'chimera': 16,
+    'pegasus': 16,
+    'zephyr': 6,
+    'heavy-hex': 4,
+}
+
+
+def source_key(qubo):
+    '''Return a hash of a QUBO's interaction graph.  Variables are
+    identified by position rather than by name, and coefficients are
+    ignored, so all QUBOs with the same structure share a key.'''
+    h = hashlib.sha256()
+    h.update(json.dumps([qubo.num_vars, qubo.interactions()]).encode())
+    return h.hexdigest()
+
+
+def target_key(sampler):
+    "Return a hash of a structured sampler's hardware graph."
+    h = hashlib.sha256()
+    edges = sorted([sorted(e) for e in sampler.edgelist])
+    h.update(json.dumps([sorted(sampler.nodelist), edges]).encode())
+    return h.hexdigest()
+
+
+def _find_chains(qubo, sampler, **minorminer_args):
+    '''Embed a QUBO's interaction graph into a sampler's hardware graph
+    with minorminer.  Return a list of chains indexed by QUBO variable.'''
+    if qubo.num_vars > len(sampler.nodelist):
+        raise ValueError('no embedding found')
+    pairs = qubo.interactions()
+    try:
+        emb = minorminer.find_embedding(pairs, sampler.edgelist,
+                                        **minorminer_args)
+    except RuntimeError:
+        # minorminer gives up early on hopelessly large problems.
+        emb = {}
+    if len(pairs) > 0 and len(emb) == 0:
+        raise ValueError('no embedding found')
+
+    # Variables that interact with no others each need a qubit of their own.
+    used = {q for chain in emb.values() for q in chain}
+    free = (q for q in sampler.nodelist if q not in used)
+    chains = []
+    for i in range(qubo.num_vars):
+        if i in emb:
+            chains.append(list(emb[i]))
+            continue
+        q = next(free, None)
+        if q is None:
+            raise ValueError('no embedding found')
+        chains.append([q])
+    return chains
+
+
+def _induced(qubo, graph, variables):
+    '''Return a QUBO with the structure of the subgraph of a QUBO's
+    interaction graph induced by a sorted list of variables.  Its
+    coefficients are all 1.'''
+    position = {v: i for i, v in enumerate(variables)}
+    pairs = sorted([sorted([position[i], position[j]])
+                    for i, j in graph.subgraph(variables).edges])
+    pairs = np.array(pairs, dtype=np.int64).reshape(len(pairs), 2)
+    return QUBO([qubo.names[v] for v in variables], 0, pairs[:, 0],
+                pairs[:, 1], np.ones(len(pairs), dtype=np.int64))
+
+
+def _components(qubo):
+    '''Split a QUBO's interaction graph into connected components.  Return
+    the graph and a list of the components' sorted variable indices,
+    largest component first.'''
+    graph = nx.Graph()
+    graph.add_nodes_from(range(qubo.num_vars))
+    graph.add_edges_from(qubo.interactions())
+    comps = [sorted(c) for c in nx.connected_components(graph)]
+    comps.sort(key=lambda c: -len(c))
+    return graph, comps
+
+
+def _heavy_hex_graph(size):
+    '''Return a heavy-hex lattice of size x size hexagons: a hexagonal
+    lattice with an additional qubit on every edge.'''
+    hexes = nx.hexagonal_lattice_graph(size, size)
+    graph = nx.Graph()
+    graph.add_nodes_from(hexes.nodes)
+    for u, v in hexes.edges:
+        graph.add_edge(u, (u, v))
+        graph.add_edge((u, v), v)
+    return nx.convert_node_labels_to_integers(graph)
+
+
+class Topology(object):
+    '''Hardware graph against which a QUBO can be embedded without a
+    sampler, represented by the same nodelist and edgelist attributes as a
+    structured dimod sampler.'''
+
+    def __init__(self, name, graph):
+        self.name = name
+        self.nodelist = sorted(graph.nodes)
+        self.edgelist = sorted([tuple(sorted(e)) for e in graph.edges])
+
+    def __repr__(self):
+        return 'Topology(%r, qubits=%d, couplers=%d)' % \
+            (self.name, len(self.nodelist), len(self.edgelist))
+
+
+_topologies = {}
+
+
+def topology(name, size=None):
+    '''Return a Topology for a named hardware graph ("chimera", "pegasus",
+    "zephyr", or "heavy-hex") of a given size.'''
+    if name not in DEFAULT_TOPOLOGY_SIZES:
+        raise ValueError('unrecognized topology "%s"' % name)
+    if size is None:
+        size = DEFAULT_TOPOLOGY_SIZES[name]
+    try:
+        return _topologies[(name, size)]
+    except KeyError:
+        pass
+    if name == 'heavy-hex':
+        graph = _heavy_hex_graph(size)
+    else:
+        import dwave_networkx as dnx
+        graph = {'chimera': dnx.chimera_graph,
+                 'pegasus': dnx.pegasus_graph,
+                 'zephyr': dnx.zephyr_graph}[name](size)
+    topo = Topology('%s-%d' % (name, size), graph)
+    _topologies[(name, size)] = topo
+    return topo
+
+
+class EmbeddingCache(LibraryCache):
+    '''Cache of minor embeddings keyed on a hash of a QUBO's interaction
+    graph and a hash of the target hardware graph.  Embeddings not found in
+    memory are sought in an optional, persistent EmbeddingLibrary.'''
+
+    noun = 'embeddings'
+
+    def clear(self):
+        super().clear()
+        self._targets = {}
+
+    def _new_library(self, directory):
+        return EmbeddingLibrary(directory)
+
+    def _target_key(self, sampler):
+        "Return the hash of a sampler's hardware graph, computing it once."
+        # Hold a reference to the sampler so its id is not reused.
+        try:
+            return self._targets[id(sampler)][1]
+        except KeyError:
+            key = target_key(sampler)
+            self._targets[id(sampler)] = (sampler, key)
+            return key
+
+    def embedding(self, qubo, sampler, **minorminer_args):
+        '''Return an embedding of a QUBO into a structured sampler's
+        hardware graph as a map from QUBO variable names to chains of
+        qubits.  Embeddings are computed with minorminer, which receives
+        minorminer_args, only if not already cached.'''
+        key = (source_key(qubo), self._target_key(sampler))
+        chains = self.lookup(key)
+        if chains is None:
+            chains = _find_chains(qubo, sampler, **minorminer_args)
+            self.store(key, chains)
+        return {nm: chains[i] for i, nm in enumerate(qubo.names)}
+
+    def _pack_chains(self, qubo, sampler, target, **minorminer_args):
+        '''Embed a QUBO component by component.  Components whose cached
+        embeddings use only qubits not yet claimed keep them; the rest are
+        embedded together into the remaining qubits with a single call to
+        minorminer, and their embeddings are cached individually.  Return
+        a list of chains indexed by QUBO variable.'''
+        free = nx.Graph()
+        free.add_nodes_from(sampler.nodelist)
+        free.add_edges_from(sampler.edgelist)
+        graph, comps = _components(qubo)
+        chains = [None]*qubo.num_vars
+        pending = []   # Components needing new embeddings, and their keys
+        for variables in comps:
+            key = (source_key(_induced(qubo, graph, variables)), target)
+            cached = self.lookup(key)
+            if cached is None or \
+               not all([free.has_node(q) for c in cached for q in c]):
+                pending.append((variables, key if cached is None else None))
+                continue
+            for v, chain in zip(variables, cached):
+                chains[v] = chain
+                free.remove_nodes_from(chain)
+        if len(pending) == 0:
+            return chains
+
+        # Embed all remaining components at once.
+        variables = sorted([v for vs, _ in pending for v in vs])
+        new_chains = _find_chains(_induced(qubo, graph, variables),
+                                  Topology('free', free), **minorminer_args)
+        for v, chain in zip(variables, new_chains):
+            chains[v] = chain
+        for vs, key in pending:
+            if key is not None:
+                self.store(key, [chains[v] for v in vs])
+        return chains
+
+    def packed_embedding(self, qubo, sampler, **minorminer_args):
+        '''Return an embedding of a QUBO, as embedding does, but find it by
+        embedding each connected component of the QUBO's interaction graph
+        separately, largest first, into qubits left free by the components
+        before it.  Each component reuses its own cached embedding when
+        that embedding's qubits are still free, so problems that share
+        components need to embed only the components they do not share.
+        If the components cannot be packed, embed the QUBO as a whole.'''
+        key = (source_key(qubo), self._target_key(sampler))
+        chains = self.lookup(key)
+        if chains is None:
+            try:
+                chains = self._pack_chains(qubo, sampler, key[1],
+                                           **minorminer_args)
+            except ValueError:
+                pass
+            if chains is None:
+                chains = _find_chains(qubo, sampler, **minorminer_args)
+            self.store(key, chains)
+        return {nm: chains[i] for i, nm in enumerate(qubo.names)}
+
+    def composite(self, qubo, sampler, pack_components=False,
+                  **minorminer_args):
+        '''Return a FixedEmbeddingComposite that maps a QUBO onto a
+        structured sampler using a cached embedding, packed component by
+        component (see packed_embedding) if pack_components is True.'''
+        from dwave.system import FixedEmbeddingComposite
+        if pack_components:
+            emb = self.packed_embedding(qubo, sampler, **minorminer_args)
+        else:
+            emb = self.embedding(qubo, sampler, **minorminer_args)
+        return FixedEmbeddingComposite(sampler, emb)
+
+
+def simulated_sampler(name='pegasus', size=None):
+    '''Return a classical, simulated-annealing sampler restricted to a
+    named hardware graph (see topology).  This is useful for exercising
+    embeddings without access to quantum hardware.'''
+    import dimod
+    topo = topology(name, size)
+    return dimod.StructureComposite(dimod.SimulatedAnnealingSampler(),
+                                    topo.nodelist, topo.edgelist)
+
+
+# Cache shared by all Ocean solves in the process.  Setting the
+# NCHOOSEK_EMBEDDING_LIBRARY environment variable to a directory name
+# enables persistent storage of embeddings in that directory.
+embedding_cache = EmbeddingCache()
+embedding_cache.use_library(os.getenv('NCHOOSEK_EMBEDDING_LIBRARY'))
@@ -0,0 +1,200 @@
+########################################
+# Find all ground states of an         #
+# NchooseK environment's QUBO by       #
+# exhaustive enumeration               #
+########################################
+
+from concurrent.futures import ProcessPoolExecutor
+from nchoosek import solver
+from nchoosek.solver import construct_indexed_qubo, local_search
+import datetime
+import numpy as np
+import os
+import time
+
+
+class TooManyVariablesError(ValueError):
+    'A QUBO has too many variables to enumerate exhaustively.'
+
+    def __init__(self, nvars, max_vars):
+        msg = 'the QUBO has %d variables, but at most %d can be enumerated' % \
+            (nvars, max_vars)
+        super().__init__(msg)
+
+
+def _bits(codes, nbits):
+    'Return a matrix with one row of nbits 0/1 values per integer code.'
+    return ((np.asarray(codes)[:, None] >> np.arange(nbits)) & 1).astype(np.int8)
+
+
+class _Enumerator(object):
+    '''Enumerate all states of a QUBO.  The first nlow variables are
+    enumerated as a single vector of 2^nlow energies.  The remaining
+    variables are stepped through in Gray-code order so that each step
+    flips a single variable and updates the energy vector by a precomputed
+    delta.'''
+
+    def __init__(self, qubo, nlow):
+        n = qubo.num_vars
+        dense = np.zeros((n, n))
+        np.add.at(dense, (qubo.rows, qubo.cols), qubo.values)
+        self.nlow = nlow
+        self.nhigh = n - nlow
+        lo = slice(0, nlow)
+        hi = slice(nlow, n)
+
+        # Energies of all assignments to the low variables.
+        low = _bits(np.arange(2**nlow), nlow).astype(np.float64)
+        self.low_energy = ((low @ dense[lo, lo])*low).sum(axis=1)
+
+        # Change in the low-variable energies when each high variable is set,
+        # stored one contiguous row per high variable
+        self.cross = np.ascontiguousarray((low @ dense[lo, hi]).T)
+
+        # Linear terms and symmetric couplings among the high variables
+        self.high_linear = np.diag(dense)[hi].copy()
+        high_quad = dense[hi, hi] - np.diag(self.high_linear)
+        self.high_quad = high_quad + high_quad.T
+
+    def energies(self, high):
+        'Return the energies of all low assignments for one high assignment.'
+        high = np.asarray(high, dtype=np.float64)
+        e_high = high @ self.high_linear + high @ np.triu(self.high_quad) @ high
+        return self.low_energy + high @ self.cross + e_high
+
+    def search(self, prefix, nprefix, deadline=None):
+        '''Enumerate all states whose top nprefix high variables equal the
+        bits of prefix.  Return the minimum energy, a list of (high code,
+        array of low codes) pairs for all states attaining it, and False if
+        the time.time() deadline passed before enumeration completed.'''
+        nfree = self.nhigh - nprefix
+        high = np.zeros(self.nhigh)
+        high[nfree:] = _bits([prefix], nprefix)[0]
+        energy = self.energies(high)
+        field = self.high_quad @ high
+        best = np.inf
+        found = []
+        code = prefix << nfree
+        for step in range(2**nfree):
+            if step > 0:
+                if deadline is not None and time.time() > deadline:
+                    return best, found, False
+                # Flip the variable corresponding to the lowest set bit of
+                # step, as in a binary-reflected Gray code.
+                j = (step & -step).bit_length() - 1
+                sign = 1.0 - 2.0*high[j]
+                if sign > 0:
+                    energy += self.cross[j]
+                else:
+                    energy -= self.cross[j]
+                energy += sign*(self.high_linear[j] + field[j])
+                field += sign*self.high_quad[:, j]
+                high[j] += sign
+                code ^= 1 << j
+            emin = energy.min()
+            tol = 1e-9*max(1.0, abs(emin))
+            if emin < best - tol:
+                best = emin
+                found = []
+            if emin <= best + tol:
+                found.append((code, np.flatnonzero(energy <= best + tol)))
+        return best, found, True
+
+
+def _search_in_worker(args):
+    'Wrap _Enumerator.search for use with a process pool.'
+    enum, prefix, nprefix, deadline = args
+    return enum.search(prefix, nprefix, deadline)
+
+
+def ground_states(qubo, max_vars=30, num_workers=1, low_bits=18,
+                  time_limit=None):
+    '''Return the minimum energy of a QUBO, an (n_states x num_vars) 0/1
+    matrix of all states that attain it, and True if the enumeration was
+    exhaustive.  The enumeration is split across num_workers processes (all
+    cores if None).  If time_limit seconds pass, return the lowest-energy
+    states found so far.'''
+    deadline = None
+    if time_limit is not None:
+        deadline = time.time() + time_limit
+    n = qubo.num_vars
+    if n > max_vars:
+        raise TooManyVariablesError(n, max_vars)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    enum = _Enumerator(qubo, min(n, low_bits))
+
+    # Assign each worker a range of high-variable prefixes.
+    nprefix = 0
+    while 2**nprefix < 4*num_workers and nprefix < enum.nhigh:
+        nprefix += 1
+    tasks = [(enum, p, nprefix, deadline) for p in range(2**nprefix)]
+    if num_workers == 1 or len(tasks) == 1:
+        parts = [_search_in_worker(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            parts = list(pool.map(_search_in_worker, tasks))
+
+    # Merge the per-prefix results.
+    best = min([p[0] for p in parts])
+    tol = 1e-9*max(1.0, abs(best))
+    complete = all([p[2] for p in parts])
+    states = []
+    for emin, found, _ in parts:
+        if emin > best + tol:
+            continue
+        for code, lows in found:
+            high = _bits([code], enum.nhigh)
+            states.append(np.hstack([_bits(lows, enum.nlow),
+                                     np.repeat(high, len(lows), axis=0)]))
+    return best, np.vstack(states), complete
+
+
+def sample_qubo(qubo, max_vars=30, num_workers=1, time_limit=None):
+    '''Return an (n_states x num_vars) 0/1 matrix of all ground states of a
+    QUBO and a vector of their energies.'''
+    energy, states, _ = ground_states(qubo, max_vars, num_workers,
+                                      time_limit=time_limit)
+    return states, np.full(len(states), energy)
+
+
+def solve(env, hard_scale=None, max_vars=30, num_workers=1, time_limit=None,
+          initial_solution=None):
+    '''Solve for the variables in a given NchooseK environment by
+    enumerating all states of its QUBO.  Return all minimum-energy
+    solutions.  A solution's tally is the number of ground states that
+    map to it.  If time_limit seconds pass, return the best solutions
+    found so far, including any in initial_solution (one or more
+    {port name: Boolean} maps) that are better than those enumerated.'''
+    # Convert the environment to a QUBO.
+    qubo = construct_indexed_qubo(env, hard_scale).coalesce()
+
+    # Find all ground states.
+    time1 = datetime.datetime.now()
+    energy, states, complete = ground_states(qubo, max_vars, num_workers,
+                                             time_limit=time_limit)
+    if initial_solution is not None and not complete:
+        initial = local_search.initial_states(qubo, initial_solution)
+        initial_energies = qubo.energies(initial)
+        emin = initial_energies.min()
+        tol = 1e-9*max(1.0, abs(emin))
+        if emin < energy - tol:
+            energy, states = emin, initial[initial_energies <= emin + tol]
+        elif emin <= energy + tol:
+            states = np.vstack([states,
+                                initial[initial_energies <= emin + tol]])
+
+    # Record the solutions, the number of ground states that map to each
+    # solution, and the energies.
+    cenv = env.compile()
+    ret = solver.Result()
+    ret.samples = solver.SampleSet.from_samples(
+        cenv.ports, states[:, :qubo.num_ports],
+        np.full(len(states), energy), port_index=cenv.port_index)
+    time2 = datetime.datetime.now()
+    ret.times = (time1, time2)
+    ret.qubits = qubo.num_vars
+    ret.status = solver.sample_status(env, ret.samples, not complete)
+    if complete and ret.status == 'feasible':
+        ret.status = 'optimal'
+    return ret
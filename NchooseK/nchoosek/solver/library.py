@@ -0,0 +1,223 @@
+########################################
+# Persistent, on-disk libraries of     #
+# QUBO templates and minor embeddings  #
+# shared across processes, and the     #
+# in-memory caches they back           #
+########################################
+
+import json
+import os
+import sqlite3
+
+
+class SQLiteLibrary(object):
+    '''Store key/value entries in an SQLite database so that they survive
+    across runs and can be shared by concurrently running processes.
+    Subclasses name the database file and its table, list the table's
+    column definitions (key columns first), and convert keys and values to
+    and from column values.'''
+
+    filename = None    # Name of the database file within the directory
+    table = None       # Name of the table holding the entries
+    columns = ()       # SQL column definitions, key columns first
+    num_keys = 1       # Number of leading columns that form the key
+
+    def __init__(self, directory, timeout=60.0):
+        self.directory = directory
+        self.timeout = timeout
+        self.path = os.path.join(directory, self.filename)
+        self._conn = None
+        self._pid = None
+        names = [c.split()[0] for c in self.columns]
+        self._key_names = names[:self.num_keys]
+        self._value_names = names[self.num_keys:]
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.path)
+
+    def _connection(self):
+        'Return a connection to the database, opening it if necessary.'
+        # SQLite connections must not be shared across a fork.
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None)
+        # Write-ahead logging lets readers proceed while another process
+        # is writing.
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (%s))' %
+                     (self.table, ', '.join(self.columns),
+                      ', '.join(self._key_names)))
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def _encode_key(self, key):
+        'Convert a key to a tuple of key-column values.'
+        raise NotImplementedError
+
+    def _encode_value(self, value):
+        'Convert a value to a tuple of value-column values.'
+        raise NotImplementedError
+
+    def _decode_value(self, row):
+        'Convert a tuple of value-column values back to a value.'
+        raise NotImplementedError
+
+    def lookup(self, key):
+        'Return the value associated with a key or None if there is none.'
+        row = self._connection().execute(
+            'SELECT %s FROM %s WHERE %s' %
+            (', '.join(self._value_names), self.table,
+             ' AND '.join(['%s = ?' % k for k in self._key_names])),
+            self._encode_key(key)).fetchone()
+        if row is None:
+            return None
+        return self._decode_value(row)
+
+    def store(self, key, value):
+        '''Associate a value with a key.  If another process stored the same
+        key first, keep its entry.'''
+        self._connection().execute(
+            'INSERT OR IGNORE INTO %s VALUES (%s)' %
+            (self.table, ', '.join(['?']*len(self.columns))),
+            self._encode_key(key) + self._encode_value(value))
+
+    def close(self):
+        'Close the connection to the database.'
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+class TemplateLibrary(SQLiteLibrary):
+    '''Store QUBO templates, as (template, number of ancillae) pairs keyed
+    on constraint shape.  Entries are tagged with an encoding version;
+    entries written under any other version are ignored.'''
+
+    filename = 'qubo-templates.sqlite'
+    table = 'templates'
+    columns = ('version INTEGER NOT NULL', 'shape TEXT NOT NULL',
+               'template TEXT', 'ancillae INTEGER NOT NULL')
+    num_keys = 2
+
+    def __init__(self, directory, version, timeout=60.0):
+        self.version = version
+        super().__init__(directory, timeout)
+
+    def __repr__(self):
+        return 'TemplateLibrary(%r, version=%d)' % (self.path, self.version)
+
+    def _encode_key(self, shape):
+        'Convert a constraint shape to a versioned key.'
+        return (self.version, json.dumps([list(shape[0]), list(shape[1])]))
+
+    def _encode_value(self, entry):
+        return (json.dumps(entry[0]), entry[1])
+
+    def _decode_value(self, row):
+        template = json.loads(row[0])
+        if template is not None:
+            template = [tuple(t) for t in template]
+        return template, row[1]
+
+    def prune(self):
+        'Delete all entries written under a different encoding version.'
+        self._connection().execute('DELETE FROM templates WHERE version != ?',
+                                   (self.version,))
+
+
+class EmbeddingLibrary(SQLiteLibrary):
+    '''Store minor embeddings, as lists of chains (lists of qubits) indexed
+    by source variable.  Entries are keyed on a (source, target) pair of a
+    hash of the source (problem) graph and a hash of the target (hardware)
+    graph.'''
+
+    filename = 'embeddings.sqlite'
+    table = 'embeddings'
+    columns = ('source TEXT NOT NULL', 'target TEXT NOT NULL',
+               'embedding TEXT NOT NULL')
+    num_keys = 2
+
+    @staticmethod
+    def _decode_qubit(q):
+        'Convert a qubit label read from JSON back to a hashable label.'
+        if isinstance(q, list):
+            return tuple(q)
+        return q
+
+    def _encode_key(self, key):
+        return tuple(key)
+
+    def _encode_value(self, chains):
+        return (json.dumps([list(c) for c in chains]),)
+
+    def _decode_value(self, row):
+        return [[self._decode_qubit(q) for q in chain]
+                for chain in json.loads(row[0])]
+
+
+class LibraryCache(object):
+    '''In-memory cache of entries, each found first in memory, then in an
+    optional, persistent SQLiteLibrary.  Subclasses name the entries (for
+    __repr__) and construct the library.'''
+
+    noun = 'entries'    # What __repr__ calls the cached entries
+
+    def __init__(self, library=None):
+        self.library = library
+        self.clear()
+
+    def clear(self):
+        '''Discard all entries cached in memory and reset the hit/miss
+        counters.  The persistent library, if any, is left untouched.'''
+        self._entries = {}
+        self.hits = 0
+        self.library_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '%s(%s=%d, hits=%d, library_hits=%d, misses=%d)' % \
+            (type(self).__name__, self.noun, len(self._entries), self.hits,
+             self.library_hits, self.misses)
+
+    def _new_library(self, directory):
+        'Return a library stored in a given directory.'
+        raise NotImplementedError
+
+    def use_library(self, directory):
+        '''Back the cache with a persistent library stored in a given
+        directory, or with no library if the directory is None.'''
+        if self.library is not None:
+            self.library.close()
+        if directory is None:
+            self.library = None
+        else:
+            self.library = self._new_library(directory)
+
+    def lookup(self, key):
+        'Return the entry for a given key or None if there is none.'
+        try:
+            entry = self._entries[key]
+            self.hits += 1
+            return entry
+        except KeyError:
+            pass
+        if self.library is not None:
+            entry = self.library.lookup(key)
+            if entry is not None:
+                self._entries[key] = entry
+                self.library_hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, entry):
+        'Associate an entry with a key.'
+        self._entries[key] = entry
+        if self.library is not None:
+            self.library.store(key, entry)
@@ -0,0 +1,127 @@
+########################################
+# Polish sampler output with classical #
+# local search over the QUBO           #
+########################################
+
+from collections.abc import Mapping
+from nchoosek import solver
+from nchoosek.solver import anneal
+import numpy as np
+
+
+def _flip(couplings, x, field, rows, cols):
+    '''Flip variable cols[k] of sample rows[k] for every k, and update the
+    samples' local fields to match.'''
+    step = 1.0 - 2.0*x[rows, cols]
+    x[rows, cols] += step
+    field[rows] += couplings.coupling[cols].multiply(step[:, None]).toarray()
+
+
+def descend(couplings, x, max_iters=None, variables=None):
+    '''Repeatedly flip, in every sample at once, the single variable that
+    most lowers the sample's energy until no flip lowers any sample's
+    energy or max_iters flips have been made.  If variables (an array of
+    indices) is given, only those variables are flipped.  Return the final
+    samples.'''
+    x = np.array(x, dtype=np.float64)
+    field = x @ couplings.coupling + couplings.linear
+    active = np.arange(len(x))
+    if variables is None:
+        variables = np.arange(couplings.num_vars)
+    if max_iters is None:
+        max_iters = 10*couplings.num_vars
+    if len(variables) == 0:
+        return x.astype(np.int8)
+    for _ in range(max_iters):
+        if len(active) == 0:
+            break
+        xa = x[active][:, variables]
+        deltas = (1.0 - 2.0*xa)*field[active][:, variables]
+        best = np.argmin(deltas, axis=1)
+        improving = deltas[np.arange(len(active)), best] < -1e-12
+        active, best = active[improving], variables[best[improving]]
+        _flip(couplings, x, field, active, best)
+    return x.astype(np.int8)
+
+
+def tabu(couplings, x, tenure=None, max_iters=None, patience=None):
+    '''Run a tabu search from every sample at once.  Each step flips the
+    variable that most lowers (or least raises) a sample's energy, except
+    that a flipped variable may not be flipped back for tenure steps unless
+    doing so yields the sample's lowest energy yet.  A sample's search
+    stops after patience steps without improvement.  Return the
+    lowest-energy state visited from each sample.'''
+    n = couplings.num_vars
+    if tenure is None:
+        tenure = max(1, min(20, n//4))
+    if max_iters is None:
+        max_iters = 10*n
+    if patience is None:
+        patience = n
+    x = np.array(x, dtype=np.float64)
+    field = x @ couplings.coupling + couplings.linear
+    energy = np.einsum('ij,ij->i', x, field + couplings.linear)/2
+    best_x = x.copy()
+    best_energy = energy.copy()
+    tabu_until = np.zeros(x.shape, dtype=np.int64)
+    stale = np.zeros(len(x), dtype=np.int64)
+    samples = np.arange(len(x))
+    for step in range(1, max_iters + 1):
+        deltas = (1.0 - 2.0*x)*field
+        aspire = energy[:, None] + deltas < best_energy[:, None] - 1e-12
+        allowed = (tabu_until < step) | aspire
+        deltas[~allowed] = np.inf
+        choice = np.argmin(deltas, axis=1)
+        moving = np.isfinite(deltas[samples, choice]) & (stale < patience)
+        if not moving.any():
+            break
+        rows, cols = samples[moving], choice[moving]
+        energy[rows] += deltas[rows, cols]
+        _flip(couplings, x, field, rows, cols)
+        tabu_until[rows, cols] = step + tenure
+
+        # Remember each sample's lowest-energy state.
+        improved = energy[rows] < best_energy[rows] - 1e-12
+        stale[rows] += 1
+        stale[rows[improved]] = 0
+        best_x[rows[improved]] = x[rows[improved]]
+        best_energy[rows[improved]] = energy[rows[improved]]
+    return best_x.astype(np.int8)
+
+
+def polish(qubo, states, method='descent', **search_args):
+    '''Improve each row of an (n_states x num_vars) 0/1 matrix of QUBO
+    states by steepest descent (method="descent") or tabu search
+    (method="tabu"), which receives search_args.  Return the improved
+    states and their energies.'''
+    couplings = anneal.Couplings(qubo)
+    if method == 'descent':
+        states = descend(couplings, states, **search_args)
+    elif method == 'tabu':
+        states = tabu(couplings, states, **search_args)
+    else:
+        raise ValueError('unrecognized local search "%s"' % method)
+    return states, qubo.energies(states)
+
+
+def initial_states(qubo, initial_solution):
+    '''Convert an initial solution, given as a {port name: Boolean} map, a
+    sequence of such maps, a SampleSet, or a Result, to an (n_states x
+    num_vars) 0/1 matrix of QUBO states.  Ports missing from a map are
+    False, and names that are not ports of the QUBO are ignored.  The
+    ancillae, which a solution does not mention, are set by steepest
+    descent with the ports held fixed.'''
+    if isinstance(initial_solution, Mapping):
+        solutions = [initial_solution]
+    elif isinstance(initial_solution, solver.Result):
+        solutions = list(initial_solution.solutions)
+    else:
+        solutions = list(initial_solution)
+    if len(solutions) == 0:
+        raise ValueError('no initial solution was given')
+    states = np.zeros((len(solutions), qubo.num_vars), dtype=np.int8)
+    ports = qubo.names[:qubo.num_ports]
+    for i, soln in enumerate(solutions):
+        states[i, :qubo.num_ports] = [bool(soln.get(p, False)) for p in ports]
+    ancillae = np.arange(qubo.num_ports, qubo.num_vars)
+    return descend(anneal.Couplings(qubo), states, variables=ancillae)
@@ -4,40 +4,118 @@
 ########################################
 
 import datetime
-from dwave.system import DWaveSampler, EmbeddingComposite
+import dimod
+import numpy as np
+from dwave.system import DWaveSampler
 from nchoosek import solver
-from nchoosek.solver import construct_qubo
+from nchoosek.solver import construct_indexed_qubo
+from nchoosek.solver import embedding, local_search
 
+# Default reverse-annealing schedule, as (time in microseconds, anneal
+# fraction) pairs, for samplers that accept a single initial state: anneal
+# backward to s = 0.45, pause, and anneal forward again.
+REVERSE_ANNEAL_SCHEDULE = [[0.0, 1.0], [5.0, 0.45], [15.0, 0.45], [20.0, 1.0]]
 
-def solve(env, sampler=None, hard_scale=None, **sampler_args):
-    'Solve for the variables in a given NchooseK environment.'
+
+def default_sampler():
+    'Return the sampler to use when none is specified.'
+    return DWaveSampler()
+
+
+def _embedded(sampler, qubo, embedding_cache=None, pack_components=False):
+    '''Wrap a structured sampler (i.e., one that accepts only problems
+    matching its hardware graph) in a composite that maps the QUBO onto it
+    with a cached embedding.  Return any other sampler unchanged.'''
+    if not isinstance(sampler, dimod.Structured):
+        return sampler
+    if embedding_cache is None:
+        embedding_cache = embedding.embedding_cache
+    return embedding_cache.composite(qubo, sampler, pack_components)
+
+
+def sample_qubo(qubo, sampler=None, embedding_cache=None, **sampler_args):
+    '''Sample a QUBO with a dimod sampler and return an (n_samples x
+    num_vars) 0/1 matrix of distinct samples and a vector of their
+    energies.'''
+    if sampler is None:
+        sampler = default_sampler()
+    sampler = _embedded(sampler, qubo, embedding_cache)
+    result = sampler.sample(qubo.to_bqm(), **sampler_args)
+    cols = [result.variables.index(nm) for nm in qubo.names]
+    states = result.record.sample[:, cols] != 0
+    return states.astype(np.int8), np.asarray(result.record.energy)
+
+
+def solve(env, sampler=None, hard_scale=None, time_limit=None,
+          embedding_cache=None, polish=None, initial_solution=None,
+          pack_components=False, **sampler_args):
+    '''Solve for the variables in a given NchooseK environment.  time_limit
+    is passed to samplers that accept a time_limit parameter (e.g., Leap's
+    hybrid samplers) and is otherwise ignored.  Problems are mapped onto
+    structured samplers using an embedding from embedding_cache (default:
+    the process-wide cache), so environments with the same structure are
+    embedded only once.  If pack_components is True, each independent
+    component of the problem is embedded separately into its own qubits
+    (see EmbeddingCache.packed_embedding), and all are still solved in a
+    single sampler call.  If polish is "descent" or "tabu", improve each
+    sample by that local search before merging identical samples.
+
+    initial_solution (one or more {port name: Boolean} maps) is passed to
+    samplers that accept initial_states (e.g., simulated annealing and tabu
+    search) or, for reverse annealing, the first solution is passed to
+    samplers that accept an initial_state (e.g., D-Wave QPUs).  Other
+    samplers ignore it.'''
     # Create a sampler if one wasn't provided.
     if sampler is None:
-        sampler = EmbeddingComposite(DWaveSampler())
+        sampler = default_sampler()
 
     # Convert the environment to a QUBO.
-    qubo = construct_qubo(env, hard_scale)
-
+    qubo = construct_indexed_qubo(env, hard_scale)
     time1 = datetime.datetime.now()
+    sampler = _embedded(sampler, qubo, embedding_cache, pack_components)
+    if time_limit is not None and 'time_limit' in sampler.parameters:
+        sampler_args['time_limit'] = time_limit
+    if initial_solution is not None:
+        initial = local_search.initial_states(qubo, initial_solution)
+        if 'initial_states' in sampler.parameters:
+            sampler_args.setdefault('initial_states', (initial, qubo.names))
+        elif 'initial_state' in sampler.parameters:
+            sampler_args.setdefault('initial_state',
+                                    dict(zip(qubo.names, initial[0].tolist())))
+            sampler_args.setdefault('anneal_schedule',
+                                    REVERSE_ANNEAL_SCHEDULE)
+
     # Solve the QUBO using the given sampler.
     ret = solver.Result()
-    result = sampler.sample_qubo(qubo, return_embedding=True, **sampler_args)
-
-    # Convert the result to a mapping from port names to Booleans and
-    # record it, the number of occurences, and the energies.
-    ports = env.ports()
-    res = []
-    num = []
-    en = []
-    for it in result.data():
-        res.append({k: v != 0 for k, v in it.sample.items() if k in ports})
-        num.append(it.num_occurrences)
-        en.append(it.energy)
-    ret.solutions = res
+    result = sampler.sample(qubo.to_bqm(), return_embedding=True,
+                            **sampler_args)
+
+    # Convert the result to a compact set of port values, and record it,
+    # the number of occurrences, and the energies, sorted by increasing
+    # energy.
+    cenv = env.compile()
+    variables = result.variables
+    record = result.record
+    if polish is not None:
+        present = [i for i, nm in enumerate(qubo.names) if nm in variables]
+        states = np.zeros((len(record), qubo.num_vars), dtype=np.int8)
+        states[:, present] = record.sample[:, [variables.index(qubo.names[i])
+                                               for i in present]]
+        states, energies = local_search.polish(qubo, states, polish)
+        ret.samples = solver.SampleSet.from_samples(
+            cenv.ports, states[:, :qubo.num_ports], energies,
+            record.num_occurrences, cenv.port_index)
+    else:
+        present = [i for i, p in enumerate(cenv.ports) if p in variables]
+        order = np.argsort(record.energy, kind='stable')
+        samples = np.zeros((len(record), cenv.num_ports), dtype=bool)
+        samples[:, present] = record.sample[:, [variables.index(cenv.ports[i])
+                                                for i in present]] != 0
+        ret.samples = solver.SampleSet(cenv.ports, samples[order],
+                                       record.num_occurrences[order],
+                                       record.energy[order], cenv.port_index)
     time2 = datetime.datetime.now()
     ret.times = (time1, time2)
-    ret.tallies = num
-    ret.energies = en
 
     # Inspect the embedding to find out how many qubits were used.
     # Simulators will not have embedding_context so we assume no
@@ -48,7 +126,8 @@ def solve(env, sampler=None, hard_scale=None, **sampler_args):
         for chain in embed.values():
             nqubs += len(chain)
     except KeyError:
-        nqubs = len(ports)
+        nqubs = cenv.num_ports
     ret.qubits = nqubs
+    ret.status = solver.sample_status(env, ret.samples)
 
     return ret
@@ -0,0 +1,94 @@
+########################################
+# Transfer optimized QAOA parameters   #
+# across similar problem instances     #
+########################################
+
+import numpy as np
+
+
+def problem_features(env, qubo):
+    '''Return a (family, degrees) pair describing an environment and its
+    QUBO.  The family is the set of distinct constraint shapes, which is
+    the same for, e.g., every graph given to the same graph problem.
+    degrees is the normalized histogram of the QUBO variables' degrees in
+    the interaction graph.'''
+    family = set()
+    for c in env.constraints():
+        family.add((len(c.port_list), tuple(sorted(c.num_true)), c.soft))
+    family = tuple(sorted(family))
+    pairs = np.array(qubo.interactions(), dtype=np.int64).reshape(-1)
+    degree = np.bincount(pairs, minlength=qubo.num_vars)
+    hist = np.bincount(degree).astype(np.float64)
+    return family, hist/max(qubo.num_vars, 1)
+
+
+def _hist_distance(h1, h2):
+    'Return the L1 distance between two degree histograms.'
+    n = max(len(h1), len(h2))
+    return np.abs(np.pad(h1, (0, n - len(h1))) -
+                  np.pad(h2, (0, n - len(h2)))).sum()
+
+
+def interpolate(params, reps):
+    '''Given reps betas followed by reps gammas, return a starting point for
+    reps + 1 layers by linearly interpolating each schedule (the INTERP
+    strategy of Zhou et al., "Quantum Approximate Optimization Algorithm:
+    Performance, Mechanism, and Implementation on Near-Term Devices").'''
+    params = np.asarray(params, dtype=np.float64)
+    ret = []
+    for sched in [params[:reps], params[reps:]]:
+        padded = np.concatenate([[0.0], sched, [0.0]])
+        i = np.arange(1, reps + 2)
+        ret.append((i - 1)/reps*padded[i - 1] + (reps - i + 1)/reps*padded[i])
+    return np.concatenate(ret)
+
+
+class ParameterStore(object):
+    '''Optimized QAOA parameters keyed on a problem family, the number of
+    QAOA layers, and a mode (e.g., whether the cost was standardized).
+    Lookups return the parameters of the stored problem whose degree
+    distribution is closest to the given problem's.'''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        'Discard all stored parameters and reset the hit/miss counters.'
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum([len(v) for v in self._entries.values()])
+
+    def __repr__(self):
+        return 'ParameterStore(entries=%d, hits=%d, misses=%d)' % \
+            (len(self), self.hits, self.misses)
+
+    def lookup(self, features, reps, mode):
+        '''Return the parameters stored for the most similar problem or None
+        if no problem of the same family, reps, and mode has been stored.'''
+        family, hist = features
+        entries = self._entries.get((family, reps, mode))
+        if not entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        best = min(entries, key=lambda e: _hist_distance(e[0], hist))
+        return np.copy(best[1])
+
+    def store(self, features, reps, mode, params):
+        '''Record the optimized parameters for a problem, replacing those of
+        any problem with an identical degree distribution.'''
+        family, hist = features
+        entries = self._entries.setdefault((family, reps, mode), [])
+        params = np.array(params, dtype=np.float64)
+        for e in entries:
+            if len(e[0]) == len(hist) and np.array_equal(e[0], hist):
+                e[1] = params
+                return
+        entries.append([hist, params])
+
+
+# Store shared by all QAOA solves in the process
+parameter_store = ParameterStore()
@@ -4,48 +4,525 @@
 #################################################
 
 from nchoosek import solver
-from nchoosek.solver import construct_qubo
+from nchoosek.solver import construct_indexed_qubo
+from nchoosek.solver import local_search, parameters
+from nchoosek.solver.exact import TooManyVariablesError
 import qiskit
 import datetime
 from qiskit_optimization import QuadraticProgram
 from qiskit_optimization.algorithms import MinimumEigenOptimizer
 from qiskit.algorithms import QAOA
-from qiskit.algorithms.optimizers import COBYLA
+from qiskit.algorithms.optimizers import COBYLA, Optimizer, OptimizerResult
+from qiskit.circuit import Parameter, QuantumCircuit
+from qiskit.circuit.library import QAOAAnsatz
+from qiskit.opflow import PauliSumOp
+from qiskit.quantum_info import PauliList, SparsePauliOp
+from qiskit.transpiler.exceptions import TranspilerError
 from qiskit.utils import QuantumInstance
+import numpy as np
+import time
 
 
-def solve(env, quantum_instance=None, hard_scale=None, optimizer=COBYLA()):
+class _DeadlineExpired(Exception):
+    'The time limit for classical optimization expired.'
+
+
+class DeadlineOptimizer(Optimizer):
+    '''Wrap a Qiskit optimizer so that it stops time_limit seconds after the
+    wrapper is created, returning the best parameters it evaluated.'''
+
+    def __init__(self, optimizer, time_limit):
+        # Optimizer.__init__ queries get_support_level().
+        self.optimizer = optimizer
+        self.time_limit = time_limit
+        self.deadline = time.time() + time_limit
+        self.expired = False
+        super().__init__()
+
+    def get_support_level(self):
+        return self.optimizer.get_support_level()
+
+    def _wrap(self, fun):
+        '''Return a wrapped objective function that raises _DeadlineExpired
+        once the deadline passes and a list that tracks the best point, its
+        value, and the number of evaluations.'''
+        best = [None, np.inf, 0]
+
+        def wrapped(x):
+            if best[0] is not None and time.time() > self.deadline:
+                self.expired = True
+                raise _DeadlineExpired()
+            val = fun(x)
+            # The objective may evaluate a batch of points at once.
+            vals = np.atleast_1d(val)
+            pts = np.reshape(x, (len(vals), -1))
+            i = int(np.argmin(vals))
+            if vals[i] < best[1]:
+                best[0], best[1] = np.copy(pts[i]), vals[i]
+            best[2] += len(vals)
+            return val
+        return wrapped, best
+
+    def minimize(self, fun, x0, jac=None, bounds=None):
+        wrapped, best = self._wrap(fun)
+        try:
+            return self.optimizer.minimize(wrapped, x0, jac=jac, bounds=bounds)
+        except _DeadlineExpired:
+            result = OptimizerResult()
+            result.x, result.fun, result.nfev = best
+            return result
+
+    def optimize(self, num_vars, objective_function, gradient_function=None,
+                 variable_bounds=None, initial_point=None):
+        wrapped, best = self._wrap(objective_function)
+        try:
+            return self.optimizer.optimize(num_vars, wrapped,
+                                           gradient_function, variable_bounds,
+                                           initial_point)
+        except _DeadlineExpired:
+            return tuple(best)
+
+
+def default_backend_model(quantum_instance):
+    '''Return the backend against which to transpile circuits for
+    reporting: the quantum_instance's backend if it is real hardware or a
+    fake Guadalupe device otherwise.'''
+    if quantum_instance is not None:
+        backend = quantum_instance.backend
+        if not backend.configuration().simulator:
+            return backend
+    from qiskit.test.mock import FakeGuadalupe
+    return FakeGuadalupe()
+
+
+def ising_operator(qubo):
+    '''Convert an indexed QUBO to an Ising Hamiltonian acting on one qubit
+    per variable, with variable i on qubit i.  Return a SparsePauliOp and
+    the constant that must be added to its eigenvalues to recover QUBO
+    energies.  The coefficients are computed with array operations, which
+    is much faster than building a QuadraticProgram and converting it.'''
+    qubo = qubo.coalesce()
+    n = qubo.num_vars
+    diag = qubo.rows == qubo.cols
+    linear = np.bincount(qubo.rows[diag], qubo.values[diag], minlength=n)
+    rows = qubo.rows[~diag]
+    cols = qubo.cols[~diag]
+    quad = qubo.values[~diag]
+
+    # Substitute x_i = (1 - Z_i)/2 into each term.
+    z_coeffs = -linear/2 - (np.bincount(rows, quad, minlength=n) +
+                            np.bincount(cols, quad, minlength=n))/4
+    offset = float(linear.sum()/2 + quad.sum()/4)
+
+    # Describe each Z_i and Z_i Z_j term by the qubits on which it acts.
+    singles = np.flatnonzero(z_coeffs)
+    nterms = len(singles) + len(quad)
+    if nterms == 0:
+        return SparsePauliOp('I'*n, [0.0]), offset
+    z = np.zeros((nterms, n), dtype=bool)
+    z[np.arange(len(singles)), singles] = True
+    pairs = np.arange(len(singles), nterms)
+    z[pairs, rows] = True
+    z[pairs, cols] = True
+    paulis = PauliList.from_symplectic(z, np.zeros_like(z))
+    coeffs = np.concatenate([z_coeffs[singles], quad/4])
+    return SparsePauliOp(paulis, coeffs), offset
+
+
+def quadratic_program(qubo):
+    '''Convert an indexed QUBO to a Qiskit QuadraticProgram.  This is the
+    slower alternative to ising_operator.'''
+    prog = QuadraticProgram('nck')
+    for var in qubo.names:
+        prog.binary_var(var)
+    prog.minimize(quadratic=qubo.to_dict())
+    return prog
+
+
+def _decode_bitstrings(bitstrings, num_qubits):
+    '''Convert Qiskit bit strings, in which qubit 0 is the rightmost bit, to
+    a 0/1 matrix with one row per string and one column per qubit.'''
+    chars = np.array(bitstrings, dtype='S%d' % num_qubits).view(np.uint8)
+    chars = chars.reshape(len(bitstrings), num_qubits)
+    return (chars[:, ::-1] == ord('1')).astype(np.int8)
+
+
+def _eigenstate_samples(eigenstate, num_qubits, shots, rng):
+    '''Return the distinct states in the eigenstate reported by QAOA, as a
+    0/1 matrix, and the number of times each was measured.  The eigenstate
+    is either a dictionary mapping measured bit strings to amplitudes, from
+    which the original counts are recovered, or a vector of amplitudes,
+    from which shots measurements are drawn.'''
+    if isinstance(eigenstate, dict):
+        states = _decode_bitstrings(list(eigenstate), num_qubits)
+        probs = np.abs(np.array(list(eigenstate.values())))**2
+        counts = np.maximum(np.rint(probs*shots), 1).astype(np.int64)
+        return states, counts
+    amps = np.asarray(getattr(eigenstate, 'data', eigenstate)).reshape(-1)
+    probs = np.abs(amps)**2
+    counts = rng.multinomial(shots, probs/probs.sum())
+    codes = np.flatnonzero(counts)
+    states = ((codes[:, None] >> np.arange(num_qubits)) & 1).astype(np.int8)
+    return states, counts[codes]
+
+
+def _run_qaoa(qaoa, qubo, problem, shots, rng):
+    '''Optimize a QAOA instance on a QUBO, presented to Qiskit as either an
+    Ising operator or a QuadraticProgram.  Return the optimized parameters,
+    a 0/1 matrix with one row per distinct state measured from the final
+    circuit, and the number of times each state was measured.'''
+    if isinstance(problem, QuadraticProgram):
+        result = MinimumEigenOptimizer(qaoa).solve(problem)
+        states = np.array([s.x for s in result.samples], dtype=np.int8)
+        probs = np.array([s.probability for s in result.samples])
+        counts = np.maximum(np.rint(probs*shots), 1).astype(np.int64)
+        return result.min_eigen_solver_result.optimal_point, states, counts
+    result = qaoa.compute_minimum_eigenvalue(problem)
+    states, counts = _eigenstate_samples(result.eigenstate, qubo.num_vars,
+                                         shots, rng)
+    return result.optimal_point, states, counts
+
+
+def _qiskit_problem(qubo, construction):
+    '''Present a QUBO to Qiskit as an Ising operator (construction="sparse")
+    or as a QuadraticProgram (construction="program").'''
+    if construction == 'sparse':
+        return PauliSumOp(ising_operator(qubo)[0])
+    if construction == 'program':
+        return quadratic_program(qubo)
+    raise ValueError('unrecognized construction "%s"' % construction)
+
+
+def warm_start_circuits(probs):
+    '''Return the initial-state and mixer circuits for warm-start QAOA (Egger
+    et al., "Warm-starting quantum optimization") given each qubit's
+    probability of being 1.  Qubit i starts in RY(theta_i)|0>, where
+    theta_i = 2 arcsin(sqrt(probs[i])), and the mixer rotates each qubit
+    about an axis tilted by theta_i from Z toward X, of which that state is
+    an eigenstate.  Probabilities of 0.5 yield standard QAOA.'''
+    thetas = 2*np.arcsin(np.sqrt(probs))
+    initial_state = QuantumCircuit(len(thetas))
+    mixer = QuantumCircuit(len(thetas))
+    beta = Parameter('beta')
+    for i, theta in enumerate(thetas.tolist()):
+        initial_state.ry(theta, i)
+        mixer.ry(-theta, i)
+        mixer.rz(2*beta, i)
+        mixer.ry(theta, i)
+    return initial_state, mixer
+
+
+def circuit_metrics(operator, backend_model, reps=1, seed_transpiler=0,
+                    initial_state=None, mixer=None):
+    '''Build the QAOA ansatz for an Ising operator, optionally with a custom
+    initial state and mixer, and transpile it locally against a backend
+    model.  Return the number of physical qubits used, the circuit depth,
+    the number of two-qubit gates, and the number of SWAPs inserted by
+    routing, or None if the ansatz does not fit on the backend.'''
+    if isinstance(operator, SparsePauliOp):
+        operator = PauliSumOp(operator)
+    ansatz = QAOAAnsatz(operator, reps=reps, initial_state=initial_state,
+                        mixer_operator=mixer)
+    ansatz.measure_all()
+    config = backend_model.configuration()
+
+    # Route the circuit with SWAPs left intact so they can be counted, then
+    # translate the routed circuit to the backend's native gates.
+    try:
+        routed = qiskit.transpile(ansatz, coupling_map=config.coupling_map,
+                                  basis_gates=config.basis_gates + ['swap'],
+                                  optimization_level=1,
+                                  seed_transpiler=seed_transpiler)
+    except TranspilerError:
+        return None
+    swaps = routed.count_ops().get('swap', 0)
+    final = qiskit.transpile(routed, backend_model,
+                             initial_layout=list(range(routed.num_qubits)),
+                             optimization_level=1,
+                             seed_transpiler=seed_transpiler)
+
+    # Count the qubits and two-qubit gates the circuit actually uses.
+    used = set()
+    two_qubit = 0
+    for inst, qargs, _ in final.data:
+        if inst.name == 'barrier':
+            continue
+        used.update([final.find_bit(q).index for q in qargs])
+        if len(qargs) == 2:
+            two_qubit += 1
+    return len(used), final.depth(), two_qubit, swaps
+
+
+def _diagonal(qubo):
+    '''Return the energy of every basis state of a QUBO, where bit i of a
+    state's index is the value of variable i.'''
+    n = qubo.num_vars
+    dense = np.zeros((n, n))
+    np.add.at(dense, (qubo.rows, qubo.cols), qubo.values)
+    energy = np.zeros(1)
+    for k in range(n):
+        # Setting variable k adds its linear term plus its couplings to
+        # whichever of variables 0..k-1 are set.
+        coupling = dense[:k, k] + dense[k, :k]
+        field = np.zeros(1)
+        for c in coupling:
+            field = np.concatenate([field, field + c])
+        energy = np.concatenate([energy, energy + dense[k, k] + field])
+    return energy
+
+
+class StatevectorQAOA(object):
+    '''Simulate QAOA exactly by evolving a NumPy statevector under the
+    QUBO's diagonal cost and a transverse-field mixer.  Parameters are
+    ordered as in Qiskit's QAOAAnsatz: reps betas followed by reps gammas.
+    The cost that drives the evolution is standardized so that good gammas
+    are of order 1 regardless of the QUBO's scale.  If warm_start (each
+    qubit's probability of being 1) is given, the initial state and mixer
+    are those of warm_start_circuits instead.'''
+
+    def __init__(self, qubo, reps=1, max_qubits=25, warm_start=None):
+        if qubo.num_vars > max_qubits:
+            raise TooManyVariablesError(qubo.num_vars, max_qubits)
+        self.num_qubits = qubo.num_vars
+        self.reps = reps
+        if warm_start is None:
+            warm_start = np.full(qubo.num_vars, 0.5)
+        self.thetas = 2*np.arcsin(np.sqrt(warm_start))
+        self.cost = _diagonal(qubo)
+        spread = self.cost.std()
+        if spread == 0:
+            spread = 1.0
+        self.phase = (self.cost - self.cost.mean())/spread
+        self.evaluations = 0
+
+    def initial_point(self):
+        'Return a linear-ramp schedule of betas and gammas.'
+        t = (np.arange(self.reps) + 0.5)/self.reps
+        return np.concatenate([(1 - t)*0.75, t*0.75])
+
+    def _mix(self, psi, beta, group=4):
+        '''Apply exp(-i beta (sin(theta) X + cos(theta) Z)) to every qubit
+        of a statevector, where theta is the qubit's mixer angle (pi/2 for
+        the standard mixer, exp(-i beta X)), group qubits at a time.
+        Applying a group's combined (Kronecker-product) rotation with a
+        single matrix product makes far fewer passes over the statevector
+        than rotating one qubit at a time.'''
+        n = self.num_qubits
+        cos, sin = np.cos(beta), np.sin(beta)
+        rots = np.empty((n, 2, 2), dtype=np.complex128)
+        rots[:, 0, 0] = cos - 1j*sin*np.cos(self.thetas)
+        rots[:, 1, 1] = cos + 1j*sin*np.cos(self.thetas)
+        rots[:, 0, 1] = -1j*sin*np.sin(self.thetas)
+        rots[:, 1, 0] = rots[:, 0, 1]
+        for j in range(0, n, group):
+            m = min(group, n - j)
+            mat = np.ones((1, 1))
+            for k in range(j + m - 1, j - 1, -1):
+                mat = np.kron(mat, rots[k])
+            if j == 0:
+                psi = psi.reshape(-1, 2**m) @ mat.T
+            else:
+                psi = np.matmul(mat, psi.reshape(-1, 2**m, 2**j))
+        return psi.reshape(-1)
+
+    def state(self, params):
+        'Return the statevector prepared by the given parameters.'
+        betas, gammas = params[:self.reps], params[self.reps:]
+        psi = np.ones(1, dtype=np.complex128)
+        for theta in self.thetas.tolist():
+            psi = np.kron([np.cos(theta/2), np.sin(theta/2)], psi)
+        for beta, gamma in zip(betas, gammas):
+            psi = self._mix(psi*np.exp(-1j*gamma*self.phase), beta)
+        return psi
+
+    def expectation(self, params):
+        'Return the exact expected energy of the given parameters.'
+        self.evaluations += 1
+        psi = self.state(params)
+        return float((psi.real**2 + psi.imag**2) @ self.cost)
+
+    def sample(self, params, shots, seed=None):
+        '''Measure the state prepared by the given parameters shots times.
+        Return a vector of distinct basis-state indices and a vector of how
+        many times each was observed.'''
+        psi = self.state(params)
+        probs = psi.real**2 + psi.imag**2
+        rng = np.random.default_rng(seed)
+        codes = rng.choice(len(probs), size=shots, p=probs/probs.sum())
+        return np.unique(codes, return_counts=True)
+
+    def decode(self, codes):
+        'Return a 0/1 matrix with one row per basis-state index.'
+        return ((np.asarray(codes)[:, None] >>
+                 np.arange(self.num_qubits)) & 1).astype(np.int8)
+
+
+def _shots(quantum_instance, shots):
+    '''Return the number of shots a quantum instance measures, or shots if
+    it returns amplitudes instead.'''
+    if quantum_instance.is_statevector:
+        return shots
+    return quantum_instance.run_config.shots
+
+
+def sample_qubo(qubo, quantum_instance=None, optimizer=COBYLA(),
+                construction='sparse', shots=1024, seed=None):
+    '''Minimize a QUBO with QAOA and return a 0/1 matrix holding the
+    distinct states measured from the final circuit, one per row, and a
+    vector holding their energies.'''
+    if not quantum_instance:
+        backend = qiskit.Aer.get_backend('qasm_simulator')
+        quantum_instance = QuantumInstance(backend)
+    qaoa = QAOA(optimizer=optimizer, reps=1,
+                quantum_instance=quantum_instance)
+    _, states, _ = _run_qaoa(qaoa, qubo, _qiskit_problem(qubo, construction),
+                             _shots(quantum_instance, shots),
+                             np.random.default_rng(seed))
+    return states, qubo.energies(states)
+
+
+def solve(env, quantum_instance=None, hard_scale=None, optimizer=COBYLA(),
+          time_limit=None, backend_model=None, statevector=False,
+          shots=1024, seed=None, reps=1, initial_point=None, transfer=True,
+          layerwise=True, parameter_store=None, construction='sparse',
+          polish=None, initial_solution=None, warm_epsilon=0.25):
+    '''Solve for the variables in a given NchooseK environment with reps
+    layers of QAOA.  Circuit metrics are computed by transpiling the QAOA
+    ansatz locally against backend_model (default: see
+    default_backend_model).  If statevector is True, simulate QAOA exactly
+    with NumPy instead of running circuits: the optimizer sees exact
+    expectation values, and shots measurements (reproducible given a seed)
+    are drawn only from the final state.  shots measurements are likewise
+    drawn from a statevector simulator's final state.  Every distinct state
+    measured from the final circuit is returned, with its count and energy.
+
+    Unless an initial_point is given, if transfer is True, the QAOA
+    parameters start from those optimized for the most similar problem in
+    parameter_store (default: the process-wide store), and the optimized
+    parameters are recorded there.  If layerwise is True, a single layer is
+    optimized first, and each additional layer starts from the previous
+    layer's parameters, interpolated.
+
+    When running circuits, the QUBO is given to Qiskit as a sparse Ising
+    operator built directly from its coefficients (construction="sparse")
+    or, more slowly, as a QuadraticProgram (construction="program").  If
+    polish is "descent" or "tabu", each measured state is improved by that
+    local search before identical states are merged.
+
+    If initial_solution (one or more {port name: Boolean} maps) is given,
+    warm-start QAOA is used (see warm_start_circuits), with each qubit's
+    probability of being 1 taken from the initial solutions and clipped to
+    [warm_epsilon, 1 - warm_epsilon] so that QAOA can still move away
+    from them.'''
     # If there is no quantum_instance given, run it on a simulator on the
     # computer running the program.
-    if not quantum_instance:
+    if statevector:
+        quantum_instance = None
+    elif not quantum_instance:
         backend = qiskit.Aer.get_backend('qasm_simulator')
         quantum_instance = QuantumInstance(backend)
+    if backend_model is None:
+        backend_model = default_backend_model(quantum_instance)
+    if parameter_store is None:
+        parameter_store = parameters.parameter_store
 
-    # Convert the environment to a QUBO.
-    qubo = construct_qubo(env, hard_scale)
+    # Convert the environment to a QUBO and then to an Ising operator.
+    iqubo = construct_indexed_qubo(env, hard_scale)
+    operator, _ = ising_operator(iqubo)
 
-    # Set up a QuadraticProgram for Qiskit.
-    prog = QuadraticProgram('nck')
-    for var in {e for qs in qubo for e in qs}:
-        prog.binary_var(var)
-    prog.minimize(quadratic=qubo)
+    # Prepare a warm start from the initial solutions.
+    warm_start = None
+    initial_state, mixer = None, None
+    if initial_solution is not None:
+        initial = local_search.initial_states(iqubo, initial_solution)
+        warm_start = np.clip(initial.mean(axis=0), warm_epsilon,
+                             1 - warm_epsilon)
+        initial_state, mixer = warm_start_circuits(warm_start)
+
+    # Determine the resources the circuit requires.
+    metrics = circuit_metrics(operator, backend_model, reps,
+                              initial_state=initial_state, mixer=mixer)
+
+    # Stop optimizing the QAOA parameters once time runs out.
+    if time_limit is not None:
+        optimizer = DeadlineOptimizer(optimizer, time_limit)
+
+    # Choose the number of layers to start from and the parameters to start
+    # with.  Parameters are transferred only between problems solved in the
+    # same mode because the statevector mode standardizes the cost and
+    # warm starts change the initial state and mixer.
+    mode = 'statevector' if statevector else 'circuit'
+    if warm_start is not None:
+        mode += '-warm'
+    features = parameters.problem_features(env, iqubo)
+    if initial_point is not None:
+        initial_point = np.asarray(initial_point, dtype=np.float64)
+        first = len(initial_point)//2
+    else:
+        first = 1 if layerwise else reps
+        if transfer:
+            # Start from the most layers for which parameters are known.
+            for layers in range(reps, first - 1, -1):
+                initial_point = parameter_store.lookup(features, layers, mode)
+                if initial_point is not None:
+                    first = layers
+                    break
 
     time1 = datetime.datetime.now()
-    # This runs the problem as a QAOA.
-    qaoa = MinimumEigenOptimizer(QAOA(optimizer=optimizer, reps=1,
-                                 quantum_instance=quantum_instance))
-    result = qaoa.solve(prog)
     ret = solver.Result()
+    if statevector:
+        qaoa = StatevectorQAOA(iqubo, first, warm_start=warm_start)
 
-    ret.solutions = []
-    ret.solutions.append({k: v != 0 for k, v in result.variables_dict.items() if k in env.ports()})
+        def run(layers, x0):
+            qaoa.reps = layers
+            if x0 is None:
+                x0 = qaoa.initial_point()
+            return optimizer.minimize(qaoa.expectation, x0).x, None, None
+    else:
+        circuit_shots = _shots(quantum_instance, shots)
+        rng = np.random.default_rng(seed)
+        if construction == 'sparse':
+            problem = PauliSumOp(operator)
+        else:
+            problem = _qiskit_problem(iqubo, construction)
+
+        def run(layers, x0):
+            qaoa = QAOA(optimizer=optimizer, reps=layers, initial_point=x0,
+                        initial_state=initial_state, mixer=mixer,
+                        quantum_instance=quantum_instance)
+            return _run_qaoa(qaoa, iqubo, problem, circuit_shots, rng)
+
+    # Optimize the QAOA parameters, adding one layer at a time.
+    params, states, counts = run(first, initial_point)
+    for layers in range(first, reps):
+        if transfer:
+            parameter_store.store(features, layers, mode, params)
+        params, states, counts = run(layers + 1,
+                                     parameters.interpolate(params, layers))
+    if transfer:
+        parameter_store.store(features, max(first, reps), mode, params)
+
+    # Convert the measured states to a compact set of port values, and
+    # record it, the number of occurrences, and the energies, sorted by
+    # increasing energy.
+    if statevector:
+        codes, counts = qaoa.sample(params, shots, seed)
+        states = qaoa.decode(codes)
+    if polish is not None:
+        states, energies = local_search.polish(iqubo, states, polish)
+    else:
+        energies = iqubo.energies(states)
+    cenv = env.compile()
+    ret.samples = solver.SampleSet.from_samples(
+        cenv.ports, states[:, :iqubo.num_ports], energies, counts,
+        cenv.port_index)
     # Record this time now to ensure that the QAOA is done running first.
     time2 = datetime.datetime.now()
     ret.times = (time1, time2)
-    ret.tallies = [1]
     ret.quantum_instance = quantum_instance
-
-    # Convert the result to a mapping from port names to Booleans and
-    # return it.
-    ports = env.ports()
+    if metrics is not None:
+        ret.qubits, ret.depth, ret.two_qubit_gates, ret.swaps = metrics
+    ret.status = solver.sample_status(env, ret.samples,
+                                      time_limit is not None and
+                                      optimizer.expired)
     return ret
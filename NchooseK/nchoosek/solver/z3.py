@@ -4,91 +4,242 @@
 # an NchooseK environment            #
 ######################################
 
+from collections.abc import Mapping
 from nchoosek import solver
-from nchoosek.solver import construct_qubo
+from nchoosek.solver import construct_indexed_qubo, local_search
 import z3
 import datetime
 
 
-def direct_solve(env):
+def _int_constraint(terms, nts):
+    '''Express "the weighted sum of the terms is one of nts" as arithmetic
+    over Z3 integers.'''
+    total = z3.Sum([m*v for v, m in terms])
+    if len(nts) == 1:
+        # Single k value
+        return total == nts[0]
+    else:
+        # Zero or multiple k values
+        return z3.Or([total == nt for nt in nts])
+
+
+def _pb_range(terms, lo, hi, total):
+    'Require the weighted sum of the terms to lie in [lo, hi].'
+    unit = all([m == 1 for v, m in terms])
+    bools = [v for v, m in terms]
+    if lo == hi:
+        return z3.PbEq(terms, lo)
+    elif lo == 0 and hi == total:
+        return z3.BoolVal(True)
+    elif lo == 0:
+        if unit:
+            return z3.AtMost(*bools, hi)
+        return z3.PbLe(terms, hi)
+    elif hi == total:
+        if unit:
+            return z3.AtLeast(*bools, lo)
+        return z3.PbGe(terms, lo)
+    else:
+        return z3.And(z3.PbGe(terms, lo), z3.PbLe(terms, hi))
+
+
+def _pb_constraint(terms, nts):
+    '''Express "the weighted sum of the terms is one of nts" with Z3's
+    pseudo-Boolean constraints, one per run of consecutive k values.'''
+    total = sum([m for v, m in terms])
+    runs = []
+    for nt in nts:
+        if runs and runs[-1][1] == nt - 1:
+            runs[-1][1] = nt
+        else:
+            runs.append([nt, nt])
+    if len(runs) == 0:
+        return z3.BoolVal(False)
+    if len(runs) == 1:
+        return _pb_range(terms, runs[0][0], runs[0][1], total)
+    return z3.Or([_pb_range(terms, lo, hi, total) for lo, hi in runs])
+
+
+def _to_number(val):
+    'Convert a Z3 numeral to a Python number or None if not a numeral.'
+    if z3.is_int_value(val):
+        return val.as_long()
+    if z3.is_rational_value(val):
+        return float(val.as_fraction())
+    return None
+
+
+def _first_solution(initial_solution):
+    '''Return the first {port name: Boolean} map of an initial solution.
+    Z3 accepts only one initial value per variable.'''
+    if isinstance(initial_solution, Mapping):
+        return initial_solution
+    if isinstance(initial_solution, solver.Result):
+        initial_solution = initial_solution.solutions
+    return initial_solution[0]
+
+
+def direct_solve(env, encoding='pb', maxsat_engine=None, time_limit=None,
+                 initial_solution=None):
     '''Solve for the variables in a given NchooseK environment by expressing
-    each constraint directly in Z3.'''
-    # Constrain all ports to be either 0 or 1.
-    s = z3.Optimize()
-    nck_to_z3 = {gp: z3.Int(gp) for gp in env.ports()}
-    for v in nck_to_z3.values():
-        s.add(v >= 0, v <= 1)
+    each constraint directly in Z3.  With the "pb" encoding, ports are Z3
+    Booleans and constraints are pseudo-Boolean constraints.  With the
+    "int" encoding, ports are Z3 integers constrained to be either 0 or 1,
+    and constraints are arithmetic sums.  Soft constraints are solved as
+    weighted MaxSAT using Z3's maxsat_engine ("maxres", "wmax",
+    "core_maxsat", etc.).  If time_limit (in seconds) expires, return the
+    best solution found so far.  The ports of initial_solution (a
+    {port name: Boolean} map or the first of a sequence of them) are given
+    to Z3 as initial values, which guide its search, if the installed Z3
+    supports them.'''
+    cenv = env.compile()
+    if encoding == 'pb':
+        nck_to_z3 = {gp: z3.Bool(gp) for gp in cenv.ports}
+        make_constraint = _pb_constraint
+        to_bool = z3.is_true
+        to_z3 = z3.BoolVal
+    elif encoding == 'int':
+        nck_to_z3 = {gp: z3.Int(gp) for gp in cenv.ports}
+        make_constraint = _int_constraint
+        to_bool = lambda val: bool(val.as_long())
+        to_z3 = lambda val: z3.IntVal(int(val))
+    else:
+        raise ValueError('unrecognized Z3 encoding "%s"' % encoding)
+    z3_vars = [nck_to_z3[gp] for gp in cenv.ports]
+
+    # Optimization is needed only if there are soft constraints.
+    if cenv.soft.any():
+        s = z3.Optimize()
+        if maxsat_engine is not None:
+            s.set(maxsat_engine=maxsat_engine)
+    else:
+        s = z3.Solver()
+    if time_limit is not None:
+        s.set(timeout=max(1, int(time_limit*1000)))
+        if isinstance(s, z3.Optimize):
+            # Large-neighborhood search improves the incumbent solution
+            # quickly, which matters if time runs out.
+            s.set(enable_lns=True)
 
-    # Express each constraint with Z3.
-    for i, c in enumerate(env.constraints()):
-        ps = [nck_to_z3[p] for p in c.port_list]
-        nts = c.num_true
+    # Constrain all integer ports to be either 0 or 1.
+    if encoding == 'int':
+        for v in z3_vars:
+            s.add(v >= 0, v <= 1)
+
+    # Express each constraint with Z3.  All soft constraints contribute to
+    # a single objective: the total weight of broken soft constraints.
+    objective = None
+    for i, c in enumerate(cenv.constraints):
+        idxs, mults = cenv.constraint_ports(i)
+        terms = [(z3_vars[j], m) for j, m in zip(idxs.tolist(),
+                                                  mults.tolist())]
+        expr = make_constraint(terms, cenv.allowed(i).tolist())
         if c.soft:
-            adder = s.add_soft
-        else:
-            adder = s.add
-        if len(nts) == 1:
-            # Single k value
-            adder(z3.Sum(ps) == list(nts)[0])
+            objective = s.add_soft(expr, c.weight)
         else:
-            # Multiple k values
-            disj = z3.BoolVector('disj%d' % i, len(nts))
-            for i, nt in enumerate(nts):
-                disj[i] = z3.Sum(ps) == nt
-            adder(z3.Or(disj))
-
-    # Solve the system of constraints, and return a dictionary mapping port
-    # names to Boolean values.
+            s.add(expr)
+
+    # Start the search from the initial solution, if any.  Older versions
+    # of Z3 cannot accept initial values, so they ignore it.
+    if initial_solution is not None and hasattr(s, 'set_initial_value'):
+        for k, v in _first_solution(initial_solution).items():
+            if k in nck_to_z3:
+                s.set_initial_value(nck_to_z3[k], to_z3(bool(v)))
+
+    # Solve the system of constraints.  If time ran out, the optimizer's
+    # model is the best solution it found.
     time1 = datetime.datetime.now()
-    if s.check() != z3.sat:
-        return None
-    model = s.model()
     ret = solver.Result()
-    ret.solutions = [{k: bool(model[v].as_long()) for k, v in nck_to_z3.items()}]
+    ret.solutions = []
+    outcome = s.check()
+    model = None
+    if outcome == z3.sat:
+        ret.status = 'optimal'
+        model = s.model()
+    elif outcome == z3.unsat:
+        ret.status = 'infeasible'
+    else:
+        ret.status = 'timeout'
+        if objective is not None:
+            try:
+                model = s.model()
+                ret.status = 'feasible'
+            except z3.Z3Exception:
+                pass
+
+    # Return a dictionary mapping port names to Boolean values.
+    if model is not None:
+        ret.solutions = [{k: to_bool(model.eval(v, model_completion=True))
+                          for k, v in nck_to_z3.items()}]
+        if objective is not None:
+            ret.bounds = (_to_number(objective.lower()),
+                          _to_number(objective.upper()))
     time2 = datetime.datetime.now()
     ret.times = (time1, time2)
     return ret
 
 
-def qubo_solve(env, hard_scale):
+def qubo_solve(env, hard_scale, time_limit=None, initial_solution=None):
     '''Solve for the variables in a given NchooseK environment by first
     expressing the constraints as a QUBO then converting that to Z3 for
-    solution.'''
+    solution.  initial_solution, if given, provides initial values for all
+    QUBO variables, including ancillae.'''
     # Convert the environment to a QUBO.
-    qubo = construct_qubo(env, hard_scale)
+    qubo = construct_indexed_qubo(env, hard_scale).coalesce()
 
     # Constrain all QUBO variables to be either 0 or 1.
-    all_vars = {e for qs in qubo for e in qs}
     s = z3.Optimize()
-    nck_to_z3 = {gp: z3.Int(gp) for gp in all_vars}
-    for v in nck_to_z3.values():
+    if time_limit is not None:
+        s.set(timeout=max(1, int(time_limit*1000)))
+    z3_vars = [z3.Int(nm) for nm in qubo.names]
+    for v in z3_vars:
         s.add(v >= 0, v <= 1)
 
     # Minimize the sum of all constraints in the QUBO.
     obj = 0
-    for (q0, q1), wt in qubo.items():
+    for q0, q1, wt in zip(qubo.rows.tolist(), qubo.cols.tolist(),
+                          qubo.values.tolist()):
         if q0 == q1:
             # Linear constraints
-            obj += wt*nck_to_z3[q0]
+            obj += wt*z3_vars[q0]
         else:
             # Quadratic constraints
-            obj += wt*nck_to_z3[q0]*nck_to_z3[q1]
+            obj += wt*z3_vars[q0]*z3_vars[q1]
     s.minimize(obj)
+    if initial_solution is not None and hasattr(s, 'set_initial_value'):
+        state = local_search.initial_states(
+            qubo, [_first_solution(initial_solution)])[0]
+        for v, val in zip(z3_vars, state.tolist()):
+            s.set_initial_value(v, z3.IntVal(val))
 
     # Minimize the objective function subject to the constraints, and
     # return a dictionary mapping port names to Boolean values.
-    if s.check() != z3.sat:
-        return None
-    model = s.model()
-    ports = env.ports()
+    time1 = datetime.datetime.now()
     ret = solver.Result()
-    ret.solutions = [{k: bool(model[v].as_long()) for k, v in nck_to_z3.items()}]
+    ret.solutions = []
+    outcome = s.check()
+    try:
+        model = s.model()
+        ret.solutions = [{nm: bool(model.eval(v,
+                                              model_completion=True).as_long())
+                          for nm, v in zip(qubo.names[:qubo.num_ports],
+                                           z3_vars)}]
+    except z3.Z3Exception:
+        pass
+    ret.status = solver.sample_status(env, ret.solutions,
+                                      outcome == z3.unknown)
+    if outcome == z3.sat and ret.status == 'feasible':
+        ret.status = 'optimal'
+    time2 = datetime.datetime.now()
+    ret.times = (time1, time2)
     return ret
 
 
-def solve(env, qubo=False, hard_scale=None):
+def solve(env, qubo=False, hard_scale=None, encoding='pb', maxsat_engine=None,
+          time_limit=None, initial_solution=None):
     'Solve for the variables in a given NchooseK environment.'
     if qubo:
-        return qubo_solve(env, hard_scale)
+        return qubo_solve(env, hard_scale, time_limit, initial_solution)
     else:
-        return direct_solve(env)
+        return direct_solve(env, encoding, maxsat_engine, time_limit,
+                            initial_solution)
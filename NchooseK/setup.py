@@ -35,6 +35,8 @@ setuptools.setup(
     license='LICENSE.md',
     python_requires='>=3.8',
     install_requires=[
+        'numpy',
+        'scipy',
         'z3-solver >= 4.8',
     ],
     packages=setuptools.find_packages(),
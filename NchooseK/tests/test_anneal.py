@@ -0,0 +1,56 @@
+########################################
+# Check the simulated-annealing solver #
+########################################
+
+import nchoosek
+from nchoosek.solver import construct_indexed_qubo
+from nchoosek.solver import anneal
+import numpy as np
+import pytest
+
+
+def _vertex_cover(nverts, nedges, seed):
+    'Return a minimum-vertex-cover environment for a random graph.'
+    rng = np.random.default_rng(seed)
+    env = nchoosek.Environment()
+    verts = [env.register_port('v%d' % i) for i in range(nverts)]
+    edges = set()
+    while len(edges) < nedges:
+        u, v = sorted(rng.choice(nverts, 2, replace=False).tolist())
+        edges.add((u, v))
+    for u, v in sorted(edges):
+        env.nck([verts[u], verts[v]], {1, 2})
+    for v in verts:
+        env.nck([v], {0}, soft=True)
+    return env
+
+
+def test_cold_end_resolves_soft_weights():
+    '''The coldest temperature rejects uphill flips as small as breaking a
+    single soft constraint, even though hard constraints are scaled up.'''
+    qubo = construct_indexed_qubo(_vertex_cover(12, 24, 1), None).coalesce()
+    couplings = anneal.Couplings(qubo)
+    assert couplings.min_delta() == 1
+    _, cold = couplings.default_beta_range()
+    assert np.exp(-cold) <= 0.01
+
+
+@pytest.mark.parametrize('num_sweeps', [10, 1000])
+def test_final_states_are_local_minima(num_sweeps):
+    'No single flip lowers the energy of any returned state.'
+    qubo = construct_indexed_qubo(_vertex_cover(20, 40, 2), None).coalesce()
+    couplings = anneal.Couplings(qubo)
+    states, _ = anneal.sample_qubo(qubo, 50, num_sweeps, seed=0)
+    field = states @ couplings.coupling + couplings.linear
+    assert np.all((1 - 2*states)*field >= -1e-9)
+
+
+def test_ground_state_yield():
+    'Most reads of a small problem reach the ground state.'
+    env = _vertex_cover(12, 24, 1)
+    exact = env.solve(solver='exact')
+    result = env.solve(solver='anneal', seed=0)
+    best = env.quality(exact.solutions[0])
+    hits = sum([t for s, t in zip(result.solutions, result.tallies)
+                if env.quality(s) == best])
+    assert hits >= 50
@@ -0,0 +1,101 @@
+########################################
+# Verify the closed-form QUBO families #
+# against their truth tables           #
+########################################
+
+import itertools
+import nchoosek
+from nchoosek.solver import bqm
+from nchoosek.solver.common import default_hard_scale
+import numpy as np
+import pytest
+
+# Port lists with various tally profiles
+PORT_LISTS = [
+    ['a', 'b'],
+    ['a', 'b', 'c'],
+    ['a', 'a', 'b'],
+    ['a', 'b', 'c', 'd', 'e'],
+    ['a', 'a', 'b', 'c', 'c', 'c'],
+    ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l'],
+]
+
+
+def _closed_form_cases():
+    '''Return a (port list, num_true) pair for every constraint in one of
+    the closed-form families: exactly k, all or nothing, at most one,
+    contiguous ranges, and constraints that are always or never
+    satisfied.'''
+    cases = []
+    for ports in PORT_LISTS:
+        total = len(ports)
+        sets = [{k} for k in range(total + 1)]
+        sets += [{0, total}, {0, 1}, set(), set(range(total + 1))]
+        sets += [set(range(a, b + 1))
+                 for a in range(total + 1) for b in range(a + 1, total + 1)]
+        for num_true in sets:
+            c = nchoosek.Constraint(ports, num_true)
+            if c._closed_form(c._column_info()) is not None:
+                cases.append((ports, num_true))
+    return cases
+
+
+@pytest.fixture(autouse=True)
+def cold_cache():
+    'Start each test from an empty, memory-only template cache.'
+    bqm.qubo_cache.use_library(None)
+    bqm.qubo_cache.clear()
+    yield
+    bqm.qubo_cache.clear()
+
+
+@pytest.mark.parametrize('ports, num_true', _closed_form_cases())
+@pytest.mark.parametrize('soft', [False, True])
+def test_truth_table(ports, num_true, soft):
+    'Every closed-form template honors its constraint\'s truth table.'
+    c = nchoosek.Constraint(ports, num_true, soft=soft)
+    assert c.check_qubo()
+
+
+@pytest.mark.parametrize('ports', PORT_LISTS)
+def test_families_are_closed_form(ports):
+    'The basic families never fall back to synthesizing a QUBO with Z3.'
+    total = len(ports)
+    for num_true in [{0}, {1}, {total}, {0, total}, {1, 2}]:
+        c = nchoosek.Constraint(ports, num_true)
+        assert c._closed_form(c._column_info()) is not None
+
+
+@pytest.mark.parametrize('ports, num_true', _closed_form_cases())
+def test_excess(ports, num_true):
+    '''template_excess agrees with an exhaustive search, including for
+    templates too wide to enumerate every row.'''
+    c = nchoosek.Constraint(ports, num_true)
+    template, _, na = c.qubo_template()
+    tallies = [ci[1] for ci in c._column_info()]
+    best = []
+    for row in itertools.product(*[[0, 1]]*len(tallies)):
+        energies = []
+        for anc in itertools.product(*[[0, 1]]*na):
+            x = list(row) + list(anc)
+            energies.append(sum([v*x[i]*x[j] for i, j, v in template]))
+        best.append(min(energies))
+    expected = max(best) - min(best) if len(template) > 0 else 0
+    assert bqm.template_excess(template, tallies, na) == expected
+
+
+def test_soft_penalty_below_hard_scale():
+    '''A soft constraint whose penalty grows quadratically does not
+    outweigh a hard constraint.'''
+    env = nchoosek.Environment()
+    p = [env.register_port('p%d' % i) for i in range(5)]
+    env.nck([p[3], p[2]], {1})
+    env.nck([p[1], p[0], p[3]], {0})
+    env.nck([p[2], p[2]], {0, 1}, soft=True)
+    env.same(p[3], p[0])
+    env.same(p[4], p[2])
+    assert default_hard_scale(env) == 5
+    result = env.solve(solver='exact')
+    hard_failed, _ = env.batch_validation(result.solutions)
+    assert result.status == 'optimal'
+    assert np.all(hard_failed == 0)
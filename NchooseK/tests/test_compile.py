@@ -0,0 +1,36 @@
+########################################
+# Check the compiled form of an        #
+# environment                          #
+########################################
+
+import nchoosek
+import pytest
+
+
+def _env_with_unused_port():
+    'Return an environment with one port that no constraint uses.'
+    env = nchoosek.Environment()
+    a = env.register_port('a')
+    b = env.register_port('b')
+    env.register_port('unused')
+    env.nck([a, b], {1})
+    env.nck([a], {1}, soft=True)
+    return env
+
+
+def test_unconstrained_port_may_be_omitted():
+    'Validating a solution does not require ports no constraint uses.'
+    env = _env_with_unused_port()
+    soln = {'a': True, 'b': False}
+    assert env.valid(soln)
+    assert env.quality(soln) == (1, 1)
+    hard_failed, soft_passed = env.batch_validation([soln])
+    assert hard_failed.tolist() == [0]
+    assert soft_passed.tolist() == [1]
+
+
+def test_constrained_port_may_not_be_omitted():
+    'A solution still must assign every port a constraint uses.'
+    env = _env_with_unused_port()
+    with pytest.raises(KeyError):
+        env.valid({'a': True})
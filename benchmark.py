@@ -0,0 +1,171 @@
+###########################################
+# Benchmark NchooseK internals on the     #
+# problem generators from run_problems.py #
+###########################################
+
+import argparse
+import os
+import random
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'NchooseK'))
+import nchoosek
+from nchoosek.solver import bqm, construct_indexed_qubo, construct_qubo
+import nchoosek.solver.z3
+from run_problems import min_vert_cover, max_cut, clique_cover, map_color, \
+    min_set_cover, exact_set_cover, SAT3
+
+
+def random_graph(nverts, nedges, rng):
+    'Return a random graph as a list of vertices and a list of edges.'
+    V = ['v%d' % i for i in range(nverts)]
+    E = set()
+    while len(E) < nedges:
+        v1, v2 = rng.sample(V, 2)
+        if (v2, v1) not in E:
+            E.add((v1, v2))
+    return V, sorted(E)
+
+
+def random_sets(nelts, nsets, rng):
+    '''Return a random universe of elements, a random collection of subsets,
+    and a random list of 3-SAT clauses, similar to those produced by
+    run_problems.py.'''
+    E = ['e%d' % i for i in range(nelts)]
+    S = {}
+    for i in range(nsets):
+        S['s%d' % i] = [e for e in E if rng.random() < 0.3]
+    for i, e in enumerate(E):
+        S['s%d' % (i % nsets)].append(e)
+    clauses = []
+    for i in range(nelts):
+        clauses.append([rng.choice(['', '!']) + v
+                        for v in rng.sample(E, 3)])
+    return E, S, clauses
+
+
+def problems(size, seed):
+    'Return a list of (name, environment) pairs.'
+    rng = random.Random(seed)
+    V, E = random_graph(size, 2*size, rng)
+    elts, sets, clauses = random_sets(size, size//2, rng)
+    return [('min_vert_cover', min_vert_cover(V, E)),
+            ('max_cut', max_cut(V, E)),
+            ('clique_cover', clique_cover(V, E, 4)),
+            ('map_color', map_color(V, E)),
+            ('min_set_cover', min_set_cover(elts, sets)),
+            ('exact_set_cover', exact_set_cover(elts, sets)),
+            ('SAT3', SAT3(clauses))]
+
+
+def bench_qubo(args):
+    '''Time construct_qubo with and without closed-form QUBOs, starting from
+    a cold cache each time, and verify every distinct constraint shape
+    against its truth table.'''
+    bqm.qubo_cache.use_library(None)
+    print('%-16s %7s %7s %12s %12s %8s' %
+          ('Problem', 'Ports', 'Constrs', 'Z3 only (s)', 'Closed (s)',
+           'Speedup'))
+    shapes = {}
+    for name, env in problems(args.size, args.seed):
+        times = []
+        for closed in [False, True]:
+            bqm.USE_CLOSED_FORMS = closed
+            bqm.qubo_cache.clear()
+            start = time.perf_counter()
+            construct_qubo(env, None)
+            times.append(time.perf_counter() - start)
+        print('%-16s %7d %7d %12.4f %12.4f %7.1fx' %
+              (name, len(env.ports()), len(env.constraints()),
+               times[0], times[1], times[0]/max(times[1], 1e-9)))
+        for c in env.constraints():
+            shapes.setdefault(c._shape(c._column_info()), c)
+
+    # Check that every template honors its truth table.
+    nbad = 0
+    nchecked = 0
+    for shape, c in sorted(shapes.items()):
+        if len(shape[0]) > args.max_check_ports:
+            continue
+        nchecked += 1
+        if not c.check_qubo():
+            print('Incorrect QUBO for %s' % c)
+            nbad += 1
+    print('%d of %d distinct constraint shapes checked; %d incorrect' %
+          (nchecked, len(shapes), nbad))
+
+
+def bench_z3(args):
+    '''Time Z3's direct solver with the integer and pseudo-Boolean
+    encodings.'''
+    print('%-16s %7s %7s %12s %12s %8s' %
+          ('Problem', 'Ports', 'Constrs', 'Int (s)', 'PB (s)', 'Speedup'))
+    for name, env in problems(args.size, args.seed):
+        if name not in args.problems:
+            continue
+        times = []
+        quals = []
+        for encoding in ['int', 'pb']:
+            start = time.perf_counter()
+            res = nchoosek.solver.z3.direct_solve(env, encoding)
+            times.append(time.perf_counter() - start)
+            quals.append(None if len(res.solutions) == 0 else
+                         env.quality(res.solutions[0]))
+        if quals[0] != quals[1]:
+            print('%s: encodings disagree (%s vs. %s)' %
+                  (name, quals[0], quals[1]))
+        print('%-16s %7d %7d %12.4f %12.4f %7.1fx' %
+              (name, len(env.ports()), len(env.constraints()),
+               times[0], times[1], times[0]/max(times[1], 1e-9)))
+
+
+def bench_qiskit(args):
+    '''Time the conversion of each problem's QUBO to an Ising operator for
+    Qiskit, both directly from the QUBO's coefficients and by way of a
+    QuadraticProgram, separately from the time to construct the QUBO
+    itself, and verify that the two operators agree.'''
+    import nchoosek.solver.qiskit as nq
+    print('%-16s %7s %7s %12s %12s %12s %8s' %
+          ('Problem', 'Vars', 'Terms', 'QUBO (s)', 'Program (s)',
+           'Sparse (s)', 'Speedup'))
+    for name, env in problems(args.size, args.seed):
+        start = time.perf_counter()
+        qubo = construct_indexed_qubo(env, None)
+        qubo_time = time.perf_counter() - start
+        start = time.perf_counter()
+        prog_op, prog_offset = nq.quadratic_program(qubo).to_ising()
+        prog_time = time.perf_counter() - start
+        start = time.perf_counter()
+        op, offset = nq.ising_operator(qubo)
+        sparse_time = time.perf_counter() - start
+        diff = (op - prog_op.primitive).simplify()
+        if abs(offset - prog_offset) > 1e-9 or \
+           max(abs(diff.coeffs)) > 1e-9:
+            print('%s: operators disagree' % name)
+        print('%-16s %7d %7d %12.4f %12.4f %12.4f %7.1fx' %
+              (name, qubo.num_vars, len(op), qubo_time, prog_time,
+               sparse_time, prog_time/max(sparse_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark NchooseK')
+    parser.add_argument('--size', type=int, default=20,
+                        help='number of vertices or elements per problem')
+    parser.add_argument('--seed', type=int, default=6,
+                        help='random-number seed')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    qubo_parser = subparsers.add_parser('qubo', help='QUBO construction')
+    qubo_parser.add_argument('--max-check-ports', type=int, default=12,
+                             help='largest constraint to verify exhaustively')
+    qubo_parser.set_defaults(func=bench_qubo)
+    z3_parser = subparsers.add_parser('z3', help='Z3 constraint encodings')
+    z3_parser.add_argument('--problems', nargs='+',
+                           default=['map_color', 'clique_cover', 'SAT3'],
+                           help='problems to solve')
+    z3_parser.set_defaults(func=bench_z3)
+    qiskit_parser = subparsers.add_parser('qiskit',
+                                          help='Qiskit operator construction')
+    qiskit_parser.set_defaults(func=bench_qiskit)
+    args = parser.parse_args()
+    args.func(args)
@@ -5,6 +5,9 @@ from qiskit.utils import QuantumInstance
 import datetime
 sys.path.append('/Users/ejwilson/nchoosek/NchooseK')
 import nchoosek
+from nchoosek.solver import soft_penalties
+from nchoosek.solver.exact import TooManyVariablesError
+import numpy as np
 import re
 import random
 from dimod import SimulatedAnnealingSampler
@@ -106,43 +109,62 @@ def SAT3(cons):
         env.nck(con, {1, 2, 3})
     return env
 
-def run_env(env, check_env, solver, simulator, quantum_instance, num_reads):
+def run_env(env, check_env, solver, simulator, quantum_instance, num_reads, time_limit=None):
     if solver == 'qiskit':
-        res = env.solve(solver=solver, quantum_instance=quantum_instance)
+        if simulator:
+            try:
+                res = env.solve(solver=solver, quantum_instance=quantum_instance, statevector=True, seed=0, time_limit=time_limit)
+            except TooManyVariablesError:
+                # Too many qubits to simulate exactly; run the circuit on the simulator instead
+                res = env.solve(solver=solver, quantum_instance=quantum_instance, time_limit=time_limit)
+        else:
+            res = env.solve(solver=solver, quantum_instance=quantum_instance, time_limit=time_limit)
         # res = time_run(env, quantum_instance)
     elif solver == 'ocean':
         if simulator:
-            res = env.solve(solver=solver, sampler=SimulatedAnnealingSampler(), num_reads=num_reads)
+            res = env.solve(solver=solver, sampler=SimulatedAnnealingSampler(), num_reads=num_reads, time_limit=time_limit)
         else:
             try:
-                res = env.solve(solver=solver, num_reads=num_reads)
+                res = env.solve(solver=solver, num_reads=num_reads, time_limit=time_limit)
             except ValueError:
                 res = None
     else:
-        res = env.solve(solver=solver)
+        try:
+            res = env.solve(solver=solver, time_limit=time_limit)
+        except TooManyVariablesError:
+            # The exact solver cannot enumerate problems this large
+            res = None
     # Get the classically optimized solution; this is needed in order to test whether our result is the actual maximum or minimum
-    ch = check_env.solve(solver='z3')
-    if not ch or not res:
+    # Small problems are enumerated exhaustively; larger ones go to z3
+    # The exact solver finds QUBO ground states, which break the fewest soft constraints only if breaking any
+    # soft constraint costs exactly 1, so otherwise z3 solves the constraints directly
+    # If the time limit expires, compare against the best solution found instead
+    ch = None
+    if all([p <= 1 for p in soft_penalties(check_env).values()]):
+        try:
+            ch = check_env.solve(solver='exact', time_limit=time_limit)
+        except TooManyVariablesError:
+            pass
+    if ch is None:
+        ch = check_env.solve(solver='z3', time_limit=time_limit)
+    if not ch or res is None:
         res = None
         count = None
         v = None
     else: 
         check = ch.solutions[0]
-        # This checks how many runs satisfied the constraints
-        v = 0
-        # This checks how many runs optimized the constraints
-        count = 0
         # Compare the quality of the results to this value
         check_quality = check_env.quality(check)
-        for r_idx, result in enumerate(res.solutions):
-            if res.tallies:
-                add = res.tallies[r_idx]
-            else:
-                add = 1
-            if env.valid(result):
-                v += add
-            if env.quality(result) == check_quality:
-                count += add
+        # Validate all of the solutions at once
+        hard_failed, soft_passed = env.batch_validation(res.solutions)
+        if res.tallies:
+            add = np.array(res.tallies)
+        else:
+            add = np.ones(len(res.solutions), dtype=int)
+        # This checks how many runs satisfied the constraints
+        v = int(add[hard_failed == 0].sum())
+        # This checks how many runs optimized the constraints
+        count = int(add[soft_passed == check_quality[0]].sum())
     return res, count, v
 
 def write_out(times, results, total_counts, envs, good_counts, n_qubs, opt_counts, n_jobs, depths, start, n_probs, time_filename, results_filename, data_filename):
@@ -183,7 +205,7 @@ def write_out(times, results, total_counts, envs, good_counts, n_qubs, opt_count
             for item in bad:
                 f.write(item)
 
-def run_graph(V, E, nCliques, solver, simulator=False, color=True, time_filename='times.dat', results_filename='results.dat', data_filename='output.dat', quantum_instance=None, nQubs=2000, num_reads=100):
+def run_graph(V, E, nCliques, solver, simulator=False, color=True, time_filename='times.dat', results_filename='results.dat', data_filename='output.dat', quantum_instance=None, nQubs=2000, num_reads=100, time_limit=None, target=None):
     # list of environments
     envs = []
     # list of lists of results
@@ -219,8 +241,10 @@ def run_graph(V, E, nCliques, solver, simulator=False, color=True, time_filename
     except ValueError:
         envs.append(None)
         check_envs.append(None)
-    # clique cover uses more qubits than the others
-    if len(V)*nCliques <= nQubs:
+    # clique cover uses more qubits than the others, but the decompose
+    # solver needs only as many qubits as its sub-problems use
+    # If a target topology is given, resource estimates decide instead
+    if len(V)*nCliques <= nQubs or solver == 'decompose' or target is not None:
         try:
             envs.append(clique_cover(V, E, nCliques))
             check_envs.append(clique_cover(V, E, nCliques))
@@ -230,7 +254,7 @@ def run_graph(V, E, nCliques, solver, simulator=False, color=True, time_filename
     else:
         envs.append(None)
         check_envs.append(None)
-    if len(V)*4 <= nQubs and color:
+    if (len(V)*4 <= nQubs or solver == 'decompose' or target is not None) and color:
         try:
             envs.append(map_color(V, E))
             check_envs.append(map_color(V, E))
@@ -240,6 +264,12 @@ def run_graph(V, E, nCliques, solver, simulator=False, color=True, time_filename
     else:
         envs.append(None)
         check_envs.append(None)
+    # Skip problems that cannot fit on the target hardware before spending queue time on them
+    if target is not None and solver != 'decompose':
+        for idx, env in enumerate(envs):
+            if env and not env.estimate_resources(target, circuit_model=(solver == 'qiskit')).fits:
+                envs[idx] = None
+                check_envs[idx] = None
     times.append(datetime.datetime.now())
 
     # Run all the problems and record the results
@@ -257,9 +287,9 @@ def run_graph(V, E, nCliques, solver, simulator=False, color=True, time_filename
             continue
         # Run the actual problem and add it to the lists
         res, count, v = run_env(env, check_envs[idx], solver, simulator,
-                                quantum_instance, num_reads)
+                                quantum_instance, num_reads, time_limit)
 
-        if res:
+        if res is not None:
             results.append(res.solutions)
             total_counts.append(res.tallies)
             opt_counts.append(count)
@@ -296,7 +326,7 @@ def run_graph(V, E, nCliques, solver, simulator=False, color=True, time_filename
 def run_other(E, S, constraints, solver, simulator=False,
               time_filename='times.dat', results_filename='results.dat',
               data_filename='output.dat', quantum_instance=None,
-              num_reads=100):
+              num_reads=100, time_limit=None):
     # list of environments
     envs = []
     # list of lists of results
@@ -358,25 +388,36 @@ def run_other(E, S, constraints, solver, simulator=False,
             continue
         # Run the actual problem and add it to the lists
         res, count, v = run_env(env, check_envs[idx], solver, simulator,
-                                quantum_instance, num_reads)
+                                quantum_instance, num_reads, time_limit)
 
-        results.append(res.solutions)
-        total_counts.append(res.tallies)
-        opt_counts.append(count)
-        good_counts.append(v)
-        n_qubs.append(res.qubits)
-        if solver=='qiskit':
-            depths.append(res.depth)
-            if res.jobIDs:
-                n_jobs.append(len(res.jobIDs))
+        if res is not None:
+            results.append(res.solutions)
+            total_counts.append(res.tallies)
+            opt_counts.append(count)
+            good_counts.append(v)
+            n_qubs.append(res.qubits)
+            if solver=='qiskit':
+                depths.append(res.depth)
+                if res.jobIDs:
+                    n_jobs.append(len(res.jobIDs))
+                else:
+                    n_jobs.append(0)
+                job_ids.append(res.jobIDs)
             else:
+                depths.append(0)
                 n_jobs.append(0)
-            job_ids.append(res.jobIDs)
+                job_ids.append(None)
+            times.append(datetime.datetime.now())
         else:
-            depths.append(0)
-            n_jobs.append(0)
+            results.append(None)
+            total_counts.append(None)
+            opt_counts.append(None)
+            good_counts.append(None)
+            n_qubs.append(None)
+            depths.append(None)
+            n_jobs.append(None)
             job_ids.append(None)
-        times.append(datetime.datetime.now())
+            times.append(datetime.datetime.now())
     write_out(times, results, total_counts, envs, good_counts,
               n_qubs, opt_counts, n_jobs, depths, 4, len(envs),
               time_filename, results_filename, data_filename)
@@ -388,7 +429,7 @@ if __name__ == '__main__':
         solver = 'z3'
     else:
         solver = str(sys.argv[1])
-        if solver != 'qiskit' and solver != 'ocean' and solver != 'z3':
+        if solver not in ['qiskit', 'ocean', 'z3', 'anneal', 'exact', 'decompose']:
             print(str(sys.argv[1]) + " solver not implemented; using z3 solver")
             solver = 'z3'
     if len(sys.argv) < 3:
@@ -420,6 +461,13 @@ if __name__ == '__main__':
                 nqubs = 1000
         else:
             nqubs = 400
+    # Hardware graph used to prune problems that cannot fit on the device
+    target = None
+    if not simulator:
+        if solver == 'qiskit':
+            target = device.configuration().coupling_map
+        elif solver == 'ocean':
+            target = 'pegasus'
 
     V = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm',
         'n', 'o', 'p', 'q', 'r', 'x', 'y', 'z', 's', 't', 'u', 'v', 'w',
@@ -476,7 +524,7 @@ if __name__ == '__main__':
     for i, j in enumerate([3, 6, 9, 12]):#, 15, 18, 21, 24, 27, 30, 33, 37, 41, 45, 50, 55, 60, 65, 75, 85, 95, 105]):
         if j > nqubs:
             break 
-        run_graph(V[:j], E[:edge_length[i]], i+1, solver, simulator=simulator, quantum_instance=quantum_instance, nQubs=nqubs)
+        run_graph(V[:j], E[:edge_length[i]], i+1, solver, simulator=simulator, quantum_instance=quantum_instance, nQubs=nqubs, target=target)
 
     E = [('a', 'b'), ('a', 'c'), ('b', 'c'), ('d', 'e'), ('d', 'f'), 
         ('e', 'f'), ('a', 'd'), ('b', 'e'), ('g', 'h'), ('h', 'i'),
@@ -497,10 +545,10 @@ if __name__ == '__main__':
             break 
         if i > 2:
             run_graph(V[:j], E[:edge_length[i]], 4, solver, simulator,
-                    False, quantum_instance=quantum_instance, nQubs=nqubs)
+                    False, quantum_instance=quantum_instance, nQubs=nqubs, target=target)
         else:
             run_graph(V[:j], E[:edge_length[i]], 4, solver, simulator=simulator,
-                    quantum_instance=quantum_instance, nQubs=nqubs)
+                    quantum_instance=quantum_instance, nQubs=nqubs, target=target)
 
     E = []
     S = {}